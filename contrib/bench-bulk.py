@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Compares DbSession.bulk_insert and bulk_upsert against inserting the same
+rows through the ORM, per 10,000 rows, in a scratch table.
+
+Usage: bench-bulk.py <connection string> [rows]
+"""
+from srht.database import Base, DbSession
+from timeit import default_timer
+import sqlalchemy as sa
+import sys
+
+class BenchRow(Base):
+    __tablename__ = "srht_bench_bulk"
+    id = sa.Column(sa.Integer, primary_key=True)
+    created = sa.Column(sa.DateTime, nullable=False)
+    updated = sa.Column(sa.DateTime, nullable=False)
+    name = sa.Column(sa.Unicode(256), nullable=False, unique=True)
+    payload = sa.Column(sa.Unicode, nullable=False)
+
+def rows(n, suffix=""):
+    return [{"name": f"row-{i}", "payload": f"payload {i}{suffix}" * 8}
+            for i in range(n)]
+
+def orm_add_commit(db, n):
+    for row in rows(n):
+        db.session.add(BenchRow(**row))
+        db.session.commit()
+
+def orm_add_all(db, n):
+    db.session.add_all([BenchRow(**row) for row in rows(n)])
+    db.session.commit()
+
+def bulk_insert(db, n):
+    db.bulk_insert(BenchRow, rows(n))
+    db.session.commit()
+
+def bulk_insert_returning(db, n):
+    db.bulk_insert(BenchRow, rows(n), returning=["id"])
+    db.session.commit()
+
+def bulk_upsert(db, n):
+    db.bulk_insert(BenchRow, rows(n))
+    db.session.commit()
+    start = default_timer()
+    db.bulk_upsert(BenchRow, rows(n, " updated"), conflict=["name"])
+    db.session.commit()
+    return default_timer() - start
+
+if __name__ == "__main__":
+    db = DbSession(sys.argv[1])
+    db.init()
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    BenchRow.__table__.drop(db.engine, checkfirst=True)
+    BenchRow.__table__.create(db.engine)
+    try:
+        for bench in [orm_add_commit, orm_add_all, bulk_insert,
+                bulk_insert_returning, bulk_upsert]:
+            db.session.execute(sa.text(
+                f"TRUNCATE {BenchRow.__tablename__}"))
+            db.session.commit()
+            start = default_timer()
+            elapsed = bench(db, n)
+            if elapsed is None:
+                elapsed = default_timer() - start
+            print(f"{bench.__name__}: {elapsed * 10000 / n:.2f}s per 10k "
+                f"rows ({n / elapsed:.0f} rows/s)")
+    finally:
+        db.session.remove()
+        BenchRow.__table__.drop(db.engine)
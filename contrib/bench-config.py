@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Compares the compiled config lookups in srht.config against looking up each
+option through ConfigParser, as srht.config did previously, for the options
+used by each request's template context.
+"""
+from configparser import ConfigParser
+from srht import config
+from srht.config import cfg, get_origin, get_network
+from timeit import timeit
+import os
+import tempfile
+
+def legacy_cfg(parser, section, key, default=None):
+    if section in parser and key in parser[section]:
+        return parser.get(section, key)
+    return default
+
+def legacy_origin(parser, service):
+    return legacy_cfg(parser, service, "internal-origin",
+            legacy_cfg(parser, service, "origin"))
+
+def legacy_network(parser):
+    return [s for s in parser if s.endswith(".sr.ht")
+            and s not in ["paste.sr.ht", "pages.sr.ht", "dispatch.sr.ht"]]
+
+services = ["meta", "git", "hg", "builds", "todo", "lists", "man", "paste",
+        "hub", "pages", "dispatch"]
+
+if __name__ == "__main__":
+    with tempfile.NamedTemporaryFile("w", suffix=".ini", delete=False) as f:
+        f.write("[sr.ht]\nsite-name=sourcehut\nenvironment=production\n"
+                "redis-host=redis://localhost\n")
+        for svc in services:
+            f.write(f"[{svc}.sr.ht]\norigin=https://{svc}.example.org\n"
+                    f"debug-port=5000\n")
+    try:
+        config.load_config([f.name])
+        parser = ConfigParser()
+        parser.read(f.name)
+    finally:
+        os.unlink(f.name)
+
+    def legacy():
+        legacy_cfg(parser, "sr.ht", "site-name")
+        legacy_cfg(parser, "sr.ht", "environment", "production")
+        legacy_network(parser)
+        for svc in services:
+            legacy_origin(parser, f"{svc}.sr.ht")
+
+    def compiled():
+        cfg("sr.ht", "site-name", default=None)
+        cfg("sr.ht", "environment", default="production")
+        get_network()
+        for svc in services:
+            get_origin(f"{svc}.sr.ht")
+
+    n = 10000
+    old = timeit(legacy, number=n) / n
+    new = timeit(compiled, number=n) / n
+    print(f"per request: ConfigParser {old*1e6:.1f}us, "
+        f"compiled {new*1e6:.1f}us ({old/new:.1f}x)")
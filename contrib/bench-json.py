@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Compares srht.codec against the standard library json module on a
+representative paginated_response payload.
+"""
+from datetime import datetime
+from decimal import Decimal
+from enum import Enum
+from srht import codec
+from srht.codec import date_handler
+from timeit import timeit
+import json
+
+class Visibility(Enum):
+    public = "PUBLIC"
+    unlisted = "UNLISTED"
+
+def record(i):
+    return {
+        "id": i,
+        "created": datetime.utcnow(),
+        "updated": datetime.utcnow(),
+        "name": f"repository-{i}",
+        "description": "A repository with a reasonably long description " * 2,
+        "visibility": Visibility.public,
+        "owner": {"canonical_name": "~example", "name": "example"},
+        "balance": Decimal("12.50"),
+        "tags": ["one", "two", "three"],
+        "stars_by_year": {2019: i, 2020: i * 2},
+    }
+
+if __name__ == "__main__":
+    print(f"encoder: {codec.encoder}, decoder: {codec.decoder}")
+    for per_page in [50, 1000]:
+        payload = {
+            "next": str(per_page),
+            "results": [record(i) for i in range(per_page)],
+            "total": 100000,
+            "results_per_page": per_page,
+        }
+        assert json.loads(codec.dumps(payload)) == \
+                json.loads(json.dumps(payload, default=date_handler))
+        n = 200
+        old = timeit(lambda: json.dumps(payload, default=date_handler),
+                number=n) / n
+        new = timeit(lambda: codec.dumps(payload), number=n) / n
+        print(f"dumps, {per_page} results: json {old*1000:.3f}ms, "
+            f"codec {new*1000:.3f}ms ({old/new:.1f}x)")
+        data = json.dumps(payload, default=date_handler).encode()
+        old = timeit(lambda: json.loads(data), number=n) / n
+        new = timeit(lambda: codec.loads(data), number=n) / n
+        print(f"loads, {per_page} results: json {old*1000:.3f}ms, "
+            f"codec {new*1000:.3f}ms ({old/new:.1f}x)")
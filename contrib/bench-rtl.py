@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Compares srht.rtl against the BeautifulSoup-based RTL annotation which it
+replaced. Usage: bench-rtl.py [page.html...]
+"""
+from bs4 import BeautifulSoup
+from srht.rtl import annotate_rtl, has_rtl
+from timeit import timeit
+import sys
+import unicodedata
+
+def legacy(data):
+    soup = BeautifulSoup(data.decode('utf8'), 'html.parser')
+    if not soup.body:
+        return data
+    for el in soup.body.find_all():
+        if el.name == 'input' or el.name == 'textarea':
+            el.attrs['dir'] = "auto"
+            continue
+        for ch in el.text:
+            if unicodedata.bidirectional(ch) in ('R', 'AL'):
+                el.attrs['dir'] = "auto"
+                break
+    return soup.encode('utf8')
+
+def current(data):
+    rtl = has_rtl(data)
+    if not rtl and b"<input" not in data and b"<textarea" not in data:
+        return data
+    html = annotate_rtl(data.decode('utf8'), rtl=rtl)
+    return html.encode('utf8') if html is not None else data
+
+def synthetic(rows, rtl):
+    text = "שלום עולם" if rtl else "hello world"
+    body = "".join(
+        f'<tr><td><a href="/~user/repo/{i}">commit {i}</a></td>'
+        f'<td><span class="text-muted">{text}</span></td></tr>'
+        for i in range(rows))
+    return (f"<!doctype html><html><head><title>log</title></head><body>"
+        f"<form><input name='search'></form><table>{body}</table>"
+        f"</body></html>").encode()
+
+if __name__ == "__main__":
+    pages = {path: open(path, "rb").read() for path in sys.argv[1:]} or {
+        "ltr, 2000 rows": synthetic(2000, False),
+        "rtl, 2000 rows": synthetic(2000, True),
+    }
+    for name, data in pages.items():
+        n = 10
+        old = timeit(lambda: legacy(data), number=n) / n
+        new = timeit(lambda: current(data), number=n) / n
+        print(f"{name}: legacy {old*1000:.2f}ms, "
+            f"current {new*1000:.2f}ms ({old/new:.1f}x)")
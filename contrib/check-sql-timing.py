@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Checks that the sql_query_duration histogram stays correct when queries run
+concurrently: runs slow and fast pg_sleep queries in parallel threads and
+verifies that each was observed with its own duration. Exits non-zero on
+failure.
+
+Usage: check-sql-timing.py <connection string> [threads]
+
+threads (default 10) must not exceed the pool's size plus its overflow.
+"""
+from prometheus_client import REGISTRY
+from sqlalchemy import text
+from srht.database import DbSession
+from time import sleep
+import sys
+import threading
+
+slow, fast = 0.3, 0.02
+
+def buckets():
+    return {le: REGISTRY.get_sample_value("sql_query_duration_bucket",
+        {"route": "", "le": le}) or 0 for le in ["0.1", "0.25", "+Inf"]}
+
+def run(db, barrier, duration):
+    with db.engine.connect() as conn:
+        barrier.wait(timeout=30)
+        if duration == fast:
+            # Start while the slow queries are running, which is when shared
+            # timing state would be overwritten
+            sleep(0.15)
+        conn.execute(text("SELECT pg_sleep(:s)"), {"s": duration})
+
+if __name__ == "__main__":
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    db = DbSession(sys.argv[1])
+    db.init()
+    with db.engine.connect() as conn:
+        # Connect once, so that the dialect's own queries are not counted
+        conn.execute(text("SELECT 1"))
+
+    before = buckets()
+    barrier = threading.Barrier(threads)
+    durations = [slow if i % 2 else fast for i in range(threads)]
+    workers = [threading.Thread(target=run, args=(db, barrier, d))
+            for d in durations]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    after = buckets()
+
+    observed = {le: after[le] - before[le] for le in after}
+    expected = {
+        "0.1": durations.count(fast),
+        "0.25": durations.count(fast),
+        "+Inf": len(durations),
+    }
+    print(f"observed: {observed}")
+    print(f"expected: {expected}")
+    if observed != expected:
+        print("FAIL: concurrent queries were timed incorrectly")
+        sys.exit(1)
+    print("ok")
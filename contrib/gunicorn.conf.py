@@ -1,11 +1,48 @@
 from prometheus_client import multiprocess
+import gc
 import shutil
 import os
 
+# Services may run gunicorn with --preload, in which case the app is loaded
+# once by the master and shared with the workers copy-on-write. The hooks
+# below work either way.
+
 def on_starting(server):
     multiprocess_dir = os.environ["prometheus_multiproc_dir"]
     shutil.rmtree(multiprocess_dir)
     os.mkdir(multiprocess_dir)
 
+def on_reload(server):
+    # Workers forked after SIGHUP inherit the master's config
+    from srht.config import load_config
+    load_config()
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        preload = getattr(server.app.wsgi(), "preload", None)
+        if preload:
+            preload()
+        # Keep the garbage collector from touching (and so copying) the
+        # master's objects in each worker
+        gc.freeze()
+
+def post_fork(server, worker):
+    # Connections opened by the master must not be shared by workers
+    from srht.database import db
+    from srht.redis import reset
+    if db:
+        db.dispose()
+    reset()
+
 def child_exit(server, worker):
-    multiprocess.mark_process_dead(worker.pid)
\ No newline at end of file
+    multiprocess.mark_process_dead(worker.pid)
+
+def post_worker_init(worker):
+    # Reload the config on SIGHUP rather than exiting, which is the default
+    # for gunicorn workers
+    from srht.config import install_reload_handler
+    install_reload_handler()
+    if not worker.cfg.preload_app:
+        preload = getattr(worker.wsgi, "preload", None)
+        if preload:
+            preload()
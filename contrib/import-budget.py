@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Measures the time taken to import srht modules with python -X importtime and
+fails if any of them exceeds the budget, so that expensive work at import
+time (loading keys, connecting to redis, importing large libraries) is
+noticed before it slows down worker boot and CLI tools.
+
+Usage: import-budget.py [budget-ms] [module...]
+"""
+import re
+import subprocess
+import sys
+
+modules = ["srht.config", "srht.crypto", "srht.redis", "srht.email",
+        "srht.database", "srht.flask", "srht.api", "srht.oauth"]
+
+_line = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+def import_times(module):
+    """Returns a list of (cumulative us, depth, name) for each import."""
+    proc = subprocess.run([sys.executable, "-X", "importtime",
+        "-c", f"import {module}"], capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise Exception(f"Importing {module} failed:\n{proc.stderr}")
+    times = []
+    for line in proc.stderr.splitlines():
+        match = _line.match(line)
+        if match:
+            _, cumulative, indent, name = match.groups()
+            times.append((int(cumulative), len(indent) // 2, name))
+    return times
+
+if __name__ == "__main__":
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 500
+    targets = sys.argv[2:] or modules
+    failed = False
+    for module in targets:
+        try:
+            times = import_times(module)
+        except Exception as ex:
+            print(ex, file=sys.stderr)
+            failed = True
+            continue
+        total = next((t for t, _, name in times if name == module), 0) / 1000
+        status = "ok" if total <= budget else "OVER BUDGET"
+        print(f"{module}: {total:.1f}ms ({status})")
+        if total > budget:
+            failed = True
+        # Top offenders among the module's direct and indirect imports
+        offenders = sorted((t for t in times if t[2] != module),
+                reverse=True)[:5]
+        for cumulative, _, name in offenders:
+            print(f"    {cumulative / 1000:8.1f}ms {name}")
+    sys.exit(1 if failed else 0)
@@ -1,12 +1,38 @@
 import requests
-from flask import current_app, request
+from flask import Response, current_app, request, stream_with_context
+from srht import codec
 from srht.crypto import encrypt_request_authorization
+from srht.deadline import http_timeout
+from srht.timing import timed
 from werkzeug.local import LocalProxy
 
 _default = 1
 
+def _stream_response(query, serialize, per_page, total, batch_size):
+    query = (query.limit(per_page + 1)
+            .execution_options(stream_results=True)
+            .yield_per(batch_size))
+
+    def generate():
+        next_id = None
+        yield '{"results": ['
+        for i, record in enumerate(query):
+            if i == per_page:
+                next_id = str(record.id)
+                break
+            yield ("," if i else "") + codec.dumps(serialize(record))
+        yield '], ' + codec.dumps({
+            "next": next_id,
+            "total": total,
+            "results_per_page": per_page,
+        })[1:]
+
+    return Response(stream_with_context(generate()),
+            mimetype="application/json")
+
 def paginated_response(id_col, query,
-        order_by=_default, serialize=_default, per_page=50, **kwargs):
+        order_by=_default, serialize=_default, per_page=50,
+        stream=False, batch_size=100, **kwargs):
     """
     Returns a standard paginated response for a given SQLAlchemy query result.
     The id_col should be the column to paginate by (generally the primary key),
@@ -19,6 +45,11 @@ def paginated_response(id_col, query,
     default is lambda r: r.to_dict().
 
     per_page is the number of results per page to return. Default is 50.
+
+    If stream is true, a streaming response is returned instead of a dict.
+    Records are fetched from a server-side cursor in batches of batch_size
+    and serialized one at a time, so that memory use does not depend on the
+    page size.
     """
     total = query.count()
     start = request.args.get('start') or -1
@@ -33,14 +64,16 @@ def paginated_response(id_col, query,
             query = query.order_by(*order_by)
         else:
             query = query.order_by(order_by)
+    if serialize is _default:
+        serialize = lambda r: r.to_dict(**kwargs)
+    if stream:
+        return _stream_response(query, serialize, per_page, total, batch_size)
     records = query.limit(per_page + 1).all()
     if len(records) != per_page + 1:
         next_id = None
     else:
         next_id = str(records[-1].id)
         records = records[:per_page]
-    if serialize is _default:
-        serialize = lambda r: r.to_dict(**kwargs)
     return {
         "next": next_id,
         "results": [serialize(record) for record in records],
@@ -55,10 +88,12 @@ def get_results(url, user):
     response = {"next": -1}
     while response.get("next") is not None:
         rurl = f"{url}?start={response['next']}"
-        r = requests.get(rurl, headers=get_authorization(user))
+        with timed("http"):
+            r = requests.get(rurl, headers=get_authorization(user),
+                    timeout=http_timeout())
         if r.status_code != 200:
             raise Exception(r.text)
-        response = r.json()
+        response = codec.loads(r.content)
         yield from response["results"]
 
 def ensure_webhooks(user, baseurl, webhooks):
@@ -20,3 +20,19 @@ def expunge_cache(key):
     """Failing to expunge the cache may be a security issue, so this is not
     wrapped in a try/except"""
     redis.delete(key)
+
+def _tag_key(tag):
+    return f"srht.cache.tag.{tag}"
+
+def get_tag_versions(tags):
+    """Returns the current version of each cache tag as a list of strings.
+    Raises if redis is unavailable, as stale entries cannot be ruled out."""
+    if not tags:
+        return []
+    return [v.decode() if v else "0"
+            for v in redis.mget([_tag_key(tag) for tag in tags])]
+
+def expunge_tag(tag):
+    """Invalidates every cache entry stored with the given tag. Like
+    expunge_cache, this is not wrapped in a try/except"""
+    redis.incr(_tag_key(tag))
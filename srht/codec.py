@@ -0,0 +1,99 @@
+"""
+srht.codec is the JSON codec used throughout sr.ht. It uses a faster JSON
+library if one is installed, falling back to the standard library:
+
+- Encoding uses python-rapidjson, which defers to date_handler for the same
+  types as the standard library does. orjson may be used instead by setting
+  [sr.ht]json-encoder=orjson, but note that it serializes Enum members by
+  value rather than by name.
+- Decoding uses orjson or python-rapidjson.
+"""
+from enum import Enum
+from srht.config import cfg
+import decimal
+import json
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S+00:00"
+
+try:
+    import rapidjson
+except ImportError:
+    rapidjson = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+JSONDecodeError = json.JSONDecodeError
+
+def date_handler(obj):
+    if hasattr(obj, 'strftime'):
+        return obj.strftime(DATE_FORMAT)
+    if isinstance(obj, decimal.Decimal):
+        return "{:.2f}".format(obj)
+    if isinstance(obj, Enum):
+        return obj.name
+    return obj
+
+def _stdlib_default(obj):
+    result = date_handler(obj)
+    if result is obj:
+        raise TypeError(
+            f"Object of type {obj.__class__.__name__} is not JSON serializable")
+    return result
+
+if orjson and cfg("sr.ht", "json-encoder", default=None) == "orjson":
+    encoder = "orjson"
+    _orjson_options = (orjson.OPT_PASSTHROUGH_DATETIME |
+            orjson.OPT_NON_STR_KEYS)
+
+    def dumps(obj):
+        """Serializes obj to a JSON string."""
+        return orjson.dumps(obj,
+                default=_stdlib_default, option=_orjson_options).decode()
+elif rapidjson:
+    encoder = "rapidjson"
+
+    def dumps(obj):
+        """Serializes obj to a JSON string."""
+        # Like the json module, accept non-str keys such as ints
+        return rapidjson.dumps(obj, default=_stdlib_default,
+                mapping_mode=rapidjson.MM_COERCE_KEYS_TO_STRINGS)
+else:
+    encoder = "json"
+
+    def dumps(obj):
+        """Serializes obj to a JSON string."""
+        return json.dumps(obj, default=_stdlib_default)
+
+if orjson:
+    decoder = "orjson"
+
+    def loads(data):
+        """
+        Deserializes a JSON document from str or bytes. Raises JSONDecodeError
+        on invalid input.
+        """
+        return orjson.loads(data)
+elif rapidjson:
+    decoder = "rapidjson"
+
+    def loads(data):
+        """
+        Deserializes a JSON document from str or bytes. Raises JSONDecodeError
+        on invalid input.
+        """
+        try:
+            return rapidjson.loads(data)
+        except rapidjson.JSONDecodeError as ex:
+            raise JSONDecodeError(str(ex), str(data), 0)
+else:
+    decoder = "json"
+
+    def loads(data):
+        """
+        Deserializes a JSON document from str or bytes. Raises JSONDecodeError
+        on invalid input.
+        """
+        return json.loads(data)
@@ -1,60 +1,138 @@
 from urllib.parse import urlparse
-from configparser import ConfigParser
+from configparser import ConfigParser, Error as ConfigParserError
 from werkzeug.local import LocalProxy
+import signal
 
 
 class _Throw:
     pass
 
+class _Missing:
+    pass
+
+_bool_values = {
+    'true': True, 'yes': True, 'on': True, '1': True,
+    'false': False, 'no': False, 'off': False, '0': False,
+}
+
+_excluded_network = ["paste.sr.ht", "pages.sr.ht", "dispatch.sr.ht"]
+
+class ConfigSnapshot:
+    """
+    An immutable view of the config file, compiled once when it is loaded so
+    that lookups do not go through ConfigParser.
+    """
+    def __init__(self, parser):
+        self.parser = parser
+        self.values = dict()
+        self.ints = dict()
+        self.bools = dict()
+        for section in parser.sections():
+            for key in parser[section]:
+                try:
+                    value = parser.get(section, key)
+                except ConfigParserError:
+                    continue # Raised again by cfg when the key is used
+                self.values[(section, key)] = value
+                try:
+                    self.ints[(section, key)] = int(value)
+                except ValueError:
+                    pass
+                if value.lower() in _bool_values:
+                    self.bools[(section, key)] = _bool_values[value.lower()]
+        self.origins = dict()
+        for section in parser.sections():
+            origin = self.values.get((section, "origin"))
+            if origin is None:
+                continue
+            self.origins[(section, True)] = origin
+            self.origins[(section, False)] = self.values.get(
+                    (section, "internal-origin"), origin)
+        self.network = [
+            s for s in parser
+            if s.endswith(".sr.ht") and s not in _excluded_network
+        ]
+        self.global_domains = dict()
+        global_domain = self.values.get(("sr.ht", "global-domain"))
+        for (section, external), origin in self.origins.items():
+            if not external:
+                continue
+            if global_domain is not None:
+                self.global_domains[section] = global_domain
+                continue
+            netloc = urlparse(origin).netloc
+            if "." in netloc:
+                self.global_domains[section] = netloc[netloc.index("."):]
 
 _config = None
+_snapshot = ConfigSnapshot(ConfigParser())
 
-config = LocalProxy(lambda: _config)
+config = LocalProxy(lambda: _snapshot.parser)
 
-def load_config():
-    global _config
-    _config = ConfigParser()
-    paths = ["config.ini", "/etc/sr.ht/config.ini"]
+def load_config(paths=["config.ini", "/etc/sr.ht/config.ini"]):
+    """
+    (Re)loads the config from the first of the given paths which exists. The
+    new config replaces the old one atomically. Note that modules which read
+    options when they are imported will not see changes.
+    """
+    global _config, _snapshot
+    parser = ConfigParser()
     for path in paths:
         try:
             with open(path) as f:
-                _config.read_file(f)
+                parser.read_file(f)
             break
         except FileNotFoundError:
             pass
+    _snapshot = ConfigSnapshot(parser)
+    _config = parser
 
 load_config()
 
+def install_reload_handler():
+    """
+    Reloads the config when this process receives SIGHUP. Must be called from
+    the main thread.
+    """
+    signal.signal(signal.SIGHUP, lambda signum, frame: load_config())
+
 def cfg(section, key, default=_Throw):
-    if _config:
-        if section in _config and key in _config[section]:
-            return _config.get(section, key)
+    snapshot = _snapshot
+    value = snapshot.values.get((section, key), _Missing)
+    if value is not _Missing:
+        return value
+    if section in snapshot.parser and key in snapshot.parser[section]:
+        return snapshot.parser.get(section, key)
     if default == _Throw:
         raise Exception("Config option [{}] {} not found".format(
             section, key))
     return default
 
 def cfgi(section, key, default=_Throw):
+    v = _snapshot.ints.get((section, key), _Missing)
+    if v is not _Missing:
+        return v
     v = cfg(section, key, default)
     if not v or v == default:
         return v
     return int(v)
 
 def cfgb(section, key, default=_Throw):
+    v = _snapshot.bools.get((section, key), _Missing)
+    if v is not _Missing:
+        return v
     v = cfg(section, key, default)
     if not v or v == default:
         return v
-    if v.lower() in ['true', 'yes', 'on', '1']:
-        return True
-    if v.lower() in ['false', 'no', 'off', '0']:
-        return False
+    if v.lower() in _bool_values:
+        return _bool_values[v.lower()]
     if default == _Throw:
         raise Exception("Config option [{}] {} isn't a boolean value.".format(
             section, key))
     return default
 
 def cfgkeys(section):
-    for key in _config[section]:
+    for key in _snapshot.parser[section]:
         yield key
 
 def get_origin(service, external=False, default=_Throw):
@@ -65,6 +143,9 @@ def get_origin(service, external=False, default=_Throw):
     internal-origin is preferred. This is designed for allowing installations
     to access sr.ht services over a different network than the external net.
     """
+    origin = _snapshot.origins.get((service, external))
+    if origin is not None:
+        return origin
     if external:
         return cfg(service, "origin", default=default)
     return cfg(service, "internal-origin", default=
@@ -76,8 +157,15 @@ def get_global_domain(site):
     the given site is a sub-domain of the global domain, i.e. it is of the
     form `blah.globaldomain.com`.
     """
+    global_domain = _snapshot.global_domains.get(site)
+    if global_domain is not None:
+        return global_domain
     global_domain = cfg("sr.ht", "global-domain", None)
     if global_domain is None:
         global_domain = urlparse(get_origin(site, external=True)).netloc
         global_domain = global_domain[global_domain.index("."):]
     return global_domain
+
+def get_network():
+    """Returns the list of sr.ht services in the network."""
+    return _snapshot.network
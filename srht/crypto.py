@@ -9,25 +9,44 @@ from cryptography.fernet import Fernet, InvalidToken
 from datetime import timedelta
 from flask import abort, Response, request, current_app
 from srht.config import cfg
+from werkzeug.local import LocalProxy
 import base64
 import binascii
 import json
 import os
 
-private_key = cfg("webhooks", "private-key")
-private_key = Ed25519PrivateKey.from_private_bytes(
-        base64.b64decode(private_key))
-public_key = private_key.public_key()
-fernet = Fernet(cfg("sr.ht", "network-key"))
+_keys = None
 
-try:
-    from srht.redis import redis
-except:
-    print("Warning: unable to initialize redis, nonce reuse will be possible")
-    redis = type("Redis", tuple(), {
-        "get": lambda *args, **kwargs: None,
-        "setex": lambda *args, **kwargs: None,
-    })
+def _load_keys():
+    # Keys are decoded on first use, as CLI tools often never sign anything
+    global _keys
+    if _keys is None:
+        private_key = Ed25519PrivateKey.from_private_bytes(
+                base64.b64decode(cfg("webhooks", "private-key")))
+        _keys = (private_key, private_key.public_key(),
+                Fernet(cfg("sr.ht", "network-key")))
+    return _keys
+
+private_key = LocalProxy(lambda: _load_keys()[0])
+public_key = LocalProxy(lambda: _load_keys()[1])
+fernet = LocalProxy(lambda: _load_keys()[2])
+
+_redis = None
+
+def _get_redis():
+    global _redis
+    if _redis is None:
+        try:
+            from srht.redis import redis as _redis
+        except:
+            print("Warning: unable to initialize redis, nonce reuse will be possible")
+            _redis = type("Redis", tuple(), {
+                "get": lambda *args, **kwargs: None,
+                "setex": lambda *args, **kwargs: None,
+            })
+    return _redis
+
+redis = LocalProxy(_get_redis)
 
 def verify_request_signature(request):
     """
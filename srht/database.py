@@ -1,16 +1,33 @@
 import hashlib
+import psycopg2.errors
 import sys
 from alembic import command, context
 from alembic.config import Config, CommandLine
 from argparse import ArgumentParser
+from asyncio import current_task
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
 from datetime import datetime
 from logging.config import dictConfig
-from prometheus_client import Histogram
-from sqlalchemy import create_engine, event, engine_from_config, pool
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import create_engine, event, engine_from_config, inspect, pool, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import scoped_session, sessionmaker
-from flask import request
-from srht.config import cfg
+from sqlalchemy.exc import OperationalError, TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from sqlalchemy.sql.selectable import SelectBase
+from flask import current_app, has_request_context, request
+from srht.config import cfg, cfgb, cfgi
+from srht.deadline import statement_timeout
+from srht.nplusone import check_statement
+from srht.slowlog import capture_statement
+from srht.timing import record
+from threading import Lock
+from time import time
 from timeit import default_timer
 from werkzeug.local import LocalProxy
 
@@ -19,18 +36,295 @@ Base = declarative_base()
 _db = None
 db = LocalProxy(lambda: _db)
 
+_async_db = None
+async_db = LocalProxy(lambda: _async_db)
+
 _metrics = type("metrics", tuple(), {
     m.describe()[0].name: m
     for m in [
         Histogram("sql_query_duration", "Duration of SQL queries", ('route',)),
+        Histogram("sql_pool_checkout_wait", "Time spent waiting for a "
+            "connection from the pool"),
+        Counter("sql_pool_timeouts", "Pool checkouts which timed out"),
+        Gauge("sql_pool_checked_out", "Connections checked out of the pool"),
+        Gauge("sql_pool_saturation", "Connections checked out of the pool, "
+            "as a fraction of the most it will open"),
     ]
 })
 
+class _TimedQueuePool(QueuePool):
+    def _do_get(self):
+        start = default_timer()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            _metrics.sql_pool_timeouts.inc()
+            raise
+        finally:
+            _metrics.sql_pool_checkout_wait.observe(
+                    max(default_timer() - start, 0))
+
+def _option(site, get, key, default=None):
+    value = get("sr.ht", key, default=default)
+    if site:
+        value = get(site, key, default=value)
+    return value
+
+def _engine_options(site):
+    """
+    Reads the engine options from the site's config section, falling back to
+    [sr.ht]:
+
+    db-pool-size: connections kept open per process (default 5)
+    db-max-overflow: connections opened beyond the pool size (default 10)
+    db-pool-timeout: seconds to wait for a connection (default 30)
+    db-pool-recycle: seconds after which connections are replaced
+    db-pool-pre-ping: test connections before using them (default no)
+    db-connect-timeout: seconds to wait to connect to the database
+    db-statement-timeout: milliseconds after which statements are cancelled
+    db-pgbouncer: connect through PgBouncer in transaction pooling mode
+
+    PgBouncer does not pass startup options on to the server, so in that mode
+    db-statement-timeout is set at the start of each session transaction
+    instead, and does not apply to statements run outside of the session.
+    """
+    options = dict()
+    connect_args = dict()
+    timeout = _option(site, cfgi, "db-connect-timeout")
+    if timeout:
+        connect_args["connect_timeout"] = timeout
+    if _option(site, cfgb, "db-pgbouncer", default=False):
+        # PgBouncer does the pooling, and does not support startup options
+        # or server-side prepared statements (which psycopg2 does not use)
+        options["poolclass"] = NullPool
+        timeout = _option(site, cfgi, "db-statement-timeout")
+        if timeout:
+            options["execution_options"] = {
+                "srht_statement_timeout": timeout,
+            }
+    else:
+        options["poolclass"] = _TimedQueuePool
+        options["pool_size"] = _option(site, cfgi, "db-pool-size",
+                default=5)
+        options["max_overflow"] = _option(site, cfgi, "db-max-overflow",
+                default=10)
+        options["pool_timeout"] = _option(site, cfgi, "db-pool-timeout",
+                default=30)
+        options["pool_recycle"] = _option(site, cfgi, "db-pool-recycle",
+                default=-1)
+        options["pool_pre_ping"] = _option(site, cfgb, "db-pool-pre-ping",
+                default=False)
+        timeout = _option(site, cfgi, "db-statement-timeout")
+        if timeout:
+            connect_args["options"] = f"-c statement_timeout={timeout}"
+    if connect_args:
+        options["connect_args"] = connect_args
+    return options
+
+primary_cookie = "sr.ht.db-primary-until"
+
+def use_replica(f):
+    """
+    Marks a view as read-only, so that its queries may be sent to a replica
+    whatever the request method. Apply this directly to the view function.
+    """
+    f._srht_db_route = "replica"
+    return f
+
+def use_primary(f):
+    """
+    Marks a view whose queries must always be sent to the primary. Apply this
+    directly to the view function.
+    """
+    f._srht_db_route = "primary"
+    return f
+
+def _replica_allowed():
+    if not has_request_context():
+        return False
+    view = current_app.view_functions.get(request.endpoint)
+    route = getattr(view, "_srht_db_route", None)
+    if route is not None:
+        return route == "replica"
+    if request.method not in ("GET", "HEAD"):
+        return False
+    # Requests shortly after a write read from the primary, so that users
+    # see their own changes
+    try:
+        return float(request.cookies.get(primary_cookie, 0)) < time()
+    except ValueError:
+        return True
+
+class Explain(Executable, ClauseElement):
+    """
+    EXPLAIN (FORMAT JSON) of a SELECT statement. Its parameters are processed
+    by SQLAlchemy as the statement's would be, and sessions may send it to a
+    replica.
+    """
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+@compiles(Explain)
+def _compile_explain(element, compiler, **kwargs):
+    return "EXPLAIN (FORMAT JSON) " + compiler.process(
+            element.statement, **kwargs)
+
+class _RoutingSession(Session):
+    """
+    Sends the queries of read-only requests to a replica. Once the session
+    writes, or runs a statement which is not a plain SELECT, it uses the
+    primary for the rest of its life, which is one request.
+    """
+    def __init__(self, *args, srht_db=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._srht_db = srht_db
+        self._srht_replica = None
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._srht_replica is None:
+            self._srht_replica = False
+            if _replica_allowed():
+                self._srht_replica = self._srht_db.pick_replica() or False
+        if self._srht_replica:
+            if self._flushing or \
+                    not isinstance(clause, (SelectBase, Explain)) or \
+                    getattr(clause, "_for_update_arg", None) is not None:
+                self._srht_replica = False
+            else:
+                return self._srht_replica
+        return super().get_bind(mapper=mapper, clause=clause, **kwargs)
+
+class _QueryStats:
+    __slots__ = ("route", "count")
+
+    def __init__(self, route):
+        self.route = route
+        self.count = 0
+
+# Set for each request, rather than consulting the request for every query
+_query_stats = ContextVar("srht_query_stats", default=None)
+
+def begin_request(route):
+    """Starts counting the SQL statements executed for a request."""
+    _query_stats.set(_QueryStats(route))
+
+def end_request():
+    _query_stats.set(None)
+
+def query_count():
+    """Returns the number of SQL statements executed by the current request."""
+    stats = _query_stats.get()
+    return stats.count if stats else 0
+
+_timestamps = False
+
+def _init_timestamps():
+    # Shared by DbSession and AsyncDbSession, and only registered once
+    global _timestamps
+    if _timestamps:
+        return
+    _timestamps = True
+
+    @event.listens_for(Base, 'before_insert', propagate=True)
+    def before_insert(mapper, connection, target):
+        if hasattr(target, '_no_autoupdate'):
+            return
+        if hasattr(target, 'created'):
+            target.created = datetime.utcnow()
+        if hasattr(target, 'updated'):
+            target.updated = datetime.utcnow()
+
+    @event.listens_for(Base, 'before_update', propagate=True)
+    def before_update(mapper, connection, target):
+        if hasattr(target, '_no_autoupdate'):
+            return
+        if hasattr(target, 'updated'):
+            target.updated = datetime.utcnow()
+
+def _set_statement_timeout(session, transaction, connection):
+    # Keep statements from outliving the request's deadline, or the
+    # db-statement-timeout which PgBouncer would not apply
+    timeout = statement_timeout()
+    default = connection.get_execution_options().get(
+            "srht_statement_timeout")
+    if default and (timeout is None or default < timeout):
+        timeout = default
+    if timeout is not None:
+        # Left out of the query metrics, as it is not the request's own
+        connection.execute(text(f"SET LOCAL statement_timeout = {timeout}")
+                .execution_options(srht_internal=True))
+
+def _init_metrics(engine):
+    # The start time is kept with the statement's execution context (or its
+    # connection, lacking one), which is never shared between threads
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement,
+                parameters, context, executemany):
+        if context is not None:
+            context._query_start = default_timer()
+        else:
+            conn.info.setdefault("_srht_query_start", []).append(
+                    default_timer())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement,
+                parameters, context, executemany):
+        if context is not None:
+            start = context._query_start
+            if context.execution_options.get("srht_internal"):
+                return
+        else:
+            start = conn.info["_srht_query_start"].pop()
+        duration = max(default_timer() - start, 0)
+        route = ""
+        stats = _query_stats.get()
+        if stats:
+            route = stats.route
+            stats.count += 1
+        _metrics.sql_query_duration.labels(route=route).observe(duration)
+        record("sql", duration)
+        capture_statement(statement, duration)
+        check_statement(statement)
+
+def _default_key(query):
+    descriptions = query.column_descriptions
+    if len(descriptions) != 1 or descriptions[0]["entity"] is None:
+        return None
+    if descriptions[0]["type"] is not descriptions[0]["entity"]:
+        return None # A single column, rather than an entity
+    primary_key = inspect(descriptions[0]["entity"]).primary_key
+    if len(primary_key) != 1:
+        return None
+    return descriptions[0]["entity"].__mapper__.get_property_by_column(
+            primary_key[0]).class_attribute
+
 class DbSession():
-    def __init__(self, connection_string, assign_global=True):
+    def __init__(self, connection_string, assign_global=True, site=None,
+            replicas=None):
+        """
+        replicas is a list of connection strings for read replicas, and
+        defaults to the site's replica-connection-strings option (separated
+        by whitespace). Read-only requests are sent to a healthy replica,
+        round robin.
+        """
         global Base, _db
-        self.engine = create_engine(connection_string)
+        self.engine = create_engine(connection_string, **_engine_options(site))
+        if replicas is None:
+            replicas = _option(site, cfg, "replica-connection-strings",
+                    default="").split()
+        self.replicas = [create_engine(r, **_engine_options(site))
+                for r in replicas]
+        self.replica_retry = _option(site, cfgi, "replica-retry", default=30)
+        self.replica_write_window = _option(site, cfgi,
+                "replica-read-your-writes", default=5)
+        self._replica_down = dict()
+        self._replica_next = 0
+        self._replica_lock = Lock()
         self.session = scoped_session(sessionmaker(
+            class_=_RoutingSession,
+            srht_db=self,
             autocommit=False,
             autoflush=False,
             bind=self.engine))
@@ -39,39 +333,286 @@ class DbSession():
             _db = self
 
     def init(self):
-        @event.listens_for(Base, 'before_insert', propagate=True)
-        def before_insert(mapper, connection, target):
-            if hasattr(target, '_no_autoupdate'):
-                return
-            if hasattr(target, 'created'):
-                target.created = datetime.utcnow()
-            if hasattr(target, 'updated'):
-                target.updated = datetime.utcnow()
-
-        @event.listens_for(Base, 'before_update', propagate=True)
-        def before_update(mapper, connection, target):
-            if hasattr(target, '_no_autoupdate'):
+        _init_timestamps()
+        event.listen(self.session, 'after_begin', _set_statement_timeout)
+
+        for engine in [self.engine] + self.replicas:
+            _init_metrics(engine)
+
+        for engine in self.replicas:
+            self._init_replica(engine)
+
+        @event.listens_for(self.engine, 'checkout')
+        def checkout(dbapi_connection, connection_record, connection_proxy):
+            self._observe_pool()
+
+        @event.listens_for(self.engine, 'checkin')
+        def checkin(dbapi_connection, connection_record):
+            self._observe_pool()
+
+    def _init_replica(self, engine):
+        @event.listens_for(engine, 'handle_error')
+        def handle_error(context):
+            # Only connection failures count, not errors such as cancelled
+            # statements, which are OperationalErrors too
+            if isinstance(context.original_exception,
+                    psycopg2.errors.QueryCanceled):
                 return
-            if hasattr(target, 'updated'):
-                target.updated = datetime.utcnow()
-
-        @event.listens_for(self.engine, 'before_cursor_execute')
-        def before_cursor_execute(conn, cursor, statement,
-                    parameters, context, executemany):
-            self._execute_start_time = default_timer()
-
-        @event.listens_for(self.engine, 'after_cursor_execute')
-        def after_cursor_execute(conn, cursor, statement,
-                    parameters, context, executemany):
-            route = ""
-            if request:
-                route = request.endpoint
-            _metrics.sql_query_duration.labels(route=route).observe(
-                max(default_timer() - self._execute_start_time, 0))
+            if context.is_disconnect or (context.connection is None and
+                    isinstance(context.sqlalchemy_exception,
+                        OperationalError)):
+                self._replica_down[engine] = time() + self.replica_retry
+
+    def pick_replica(self):
+        """
+        Returns the next healthy replica engine, or None if there are none.
+        Replicas which failed are skipped for replica-retry seconds.
+        """
+        if not self.replicas:
+            return None
+        now = time()
+        with self._replica_lock:
+            for _ in range(len(self.replicas)):
+                engine = self.replicas[self._replica_next]
+                self._replica_next = \
+                        (self._replica_next + 1) % len(self.replicas)
+                if self._replica_down.get(engine, 0) <= now:
+                    return engine
+        return None
+
+    def _observe_pool(self):
+        pool = self.engine.pool
+        if not isinstance(pool, QueuePool):
+            return
+        checked_out = pool.checkedout()
+        _metrics.sql_pool_checked_out.set(checked_out)
+        limit = pool.size() + max(pool._max_overflow, 0)
+        if limit > 0:
+            _metrics.sql_pool_saturation.set(checked_out / limit)
 
     def create(self):
         Base.metadata.create_all(bind=self.engine)
 
+    def bulk_insert(self, model, rows, conflict=None, update=None,
+            returning=None, batch_size=1000):
+        """
+        Inserts many rows with multi-row INSERT statements, as part of the
+        session's transaction. model is a mapped class or a table, and rows
+        are dicts of column keys to values, which must all have the same
+        keys. created and updated are filled in as they are for ORM inserts.
+
+        conflict: the columns of a unique index. Rows which conflict with an
+        existing row are skipped, or update the columns listed in update.
+        returning: columns to return for each row inserted or updated.
+
+        Returns the list of rows returned, or the number of rows affected if
+        returning is not given.
+        """
+        table = getattr(model, "__table__", model)
+        rows = [dict(row) for row in rows]
+        if not rows:
+            return [] if returning else 0
+        autoupdate = not hasattr(model, "_no_autoupdate")
+        if autoupdate:
+            now = datetime.utcnow()
+            for key in ("created", "updated"):
+                if key in table.c:
+                    for row in rows:
+                        row.setdefault(key, now)
+
+        stmt = pg_insert(table)
+        if conflict and update:
+            values = {key: stmt.excluded[key] for key in update}
+            if autoupdate and "updated" in table.c:
+                values.setdefault("updated", stmt.excluded["updated"])
+            stmt = stmt.on_conflict_do_update(
+                    index_elements=conflict, set_=values)
+        elif conflict:
+            stmt = stmt.on_conflict_do_nothing(index_elements=conflict)
+        if returning:
+            stmt = stmt.returning(*[table.c[c] if isinstance(c, str) else c
+                for c in returning])
+
+        # Postgres allows at most 65535 parameters per statement
+        batch_size = max(min(batch_size, 65535 // len(rows[0])), 1)
+        results = list()
+        affected = 0
+        for i in range(0, len(rows), batch_size):
+            result = self.session.execute(stmt.values(rows[i:i+batch_size]))
+            if returning:
+                results.extend(result.fetchall())
+            else:
+                affected += result.rowcount
+        return results if returning else affected
+
+    def bulk_upsert(self, model, rows, conflict, update=None, **kwargs):
+        """
+        Inserts many rows, updating those which conflict with an existing
+        row. update defaults to every column given other than the conflict
+        columns and created. See bulk_insert.
+        """
+        rows = [dict(row) for row in rows]
+        if update is None and rows:
+            update = [key for key in rows[0]
+                    if key not in conflict and key != "created"]
+        return self.bulk_insert(model, rows, conflict=conflict,
+                update=update, **kwargs)
+
+    def stream_chunks(self, query, batch_size=1000, key=None):
+        """
+        Yields the results of a query as lists of at most batch_size results,
+        so that large tables can be walked with bounded memory.
+
+        The results are paged through in the order of key, a unique column,
+        with a separate query for each chunk. The caller may commit between
+        chunks. key defaults to the primary key of the query's entity. If
+        key is False, or there is no default, the results are read from a
+        server-side cursor instead, in the query's own order. Then the caller
+        must not commit or roll back until the results are exhausted.
+        """
+        if key is None:
+            key = _default_key(query)
+        if key is False or key is None:
+            results = query.execution_options(
+                    stream_results=True).yield_per(batch_size)
+            chunk = list()
+            for result in results:
+                chunk.append(result)
+                if len(chunk) >= batch_size:
+                    yield chunk
+                    chunk = list()
+            if chunk:
+                yield chunk
+            return
+
+        query = query.order_by(None).order_by(key)
+        last = None
+        while True:
+            page = query
+            if last is not None:
+                page = page.filter(key > last)
+            chunk = page.limit(batch_size).all()
+            if not chunk:
+                return
+            # Read before the caller can commit, which would expire it
+            last = getattr(chunk[-1], key.key)
+            yield chunk
+            if len(chunk) < batch_size:
+                return
+
+    def stream(self, query, batch_size=1000, key=None):
+        """
+        Yields the results of a query one at a time, fetching them in chunks.
+        See stream_chunks.
+        """
+        for chunk in self.stream_chunks(query, batch_size, key):
+            yield from chunk
+
+    def dispose(self):
+        """
+        Discards the connection pool and sessions without closing their
+        connections, which belong to the parent process. Call this in forked
+        processes before using the database.
+        """
+        self.session.registry.clear()
+        for engine in [self.engine] + self.replicas:
+            try:
+                engine.dispose(close=False)
+            except TypeError:
+                # SQLAlchemy < 1.4.33 closes the pool's connections on dispose
+                engine.pool = engine.pool.recreate()
+
+class _AsyncSyncSession(Session):
+    # The sessions wrapped by AsyncSession, to which event listeners attach
+    pass
+
+def _async_url(connection_string):
+    url = make_url(connection_string)
+    if url.drivername in ("postgres", "postgresql", "postgresql+psycopg2"):
+        url = url.set(drivername="postgresql+asyncpg")
+    return url
+
+def _async_engine_options(site, pool):
+    from sqlalchemy.pool import AsyncAdaptedQueuePool
+    options = _engine_options(site)
+    sync_args = options.pop("connect_args", dict())
+    connect_args = dict()
+    if "connect_timeout" in sync_args:
+        connect_args["timeout"] = sync_args["connect_timeout"]
+    if options["poolclass"] is NullPool:
+        # PgBouncer in transaction pooling mode can't use the prepared
+        # statements which asyncpg caches by default
+        connect_args["statement_cache_size"] = 0
+        connect_args["prepared_statement_cache_size"] = 0
+    else:
+        timeout = _option(site, cfgi, "db-statement-timeout")
+        if timeout:
+            connect_args["server_settings"] = {
+                "statement_timeout": str(timeout),
+            }
+    if options["poolclass"] is NullPool or not pool:
+        options = {key: value for key, value in options.items()
+                if key == "execution_options"}
+        options["poolclass"] = NullPool
+    else:
+        options["poolclass"] = AsyncAdaptedQueuePool
+    if connect_args:
+        options["connect_args"] = connect_args
+    return options
+
+class AsyncDbSession():
+    """
+    The asyncio counterpart of DbSession, for async views and webhook
+    workers. It requires SQLAlchemy 1.4 and asyncpg, shares the models, the
+    created/updated timestamps, request deadlines and query metrics with
+    DbSession, and reads the same pool options. Its session is scoped to
+    the current asyncio task:
+
+        async with async_db.scope() as session:
+            user = (await session.execute(select(User)
+                .where(User.username == username))).scalar_one()
+
+    Flask runs each async view in an event loop of its own, whose connections
+    cannot be used from the next, so pass pool=False there.
+    """
+    def __init__(self, connection_string, assign_global=True, site=None,
+            pool=True):
+        global _async_db
+        from sqlalchemy.ext.asyncio import AsyncSession
+        from sqlalchemy.ext.asyncio import async_scoped_session
+        from sqlalchemy.ext.asyncio import create_async_engine
+        self.engine = create_async_engine(_async_url(connection_string),
+                **_async_engine_options(site, pool))
+        self.session = async_scoped_session(sessionmaker(
+            class_=AsyncSession,
+            sync_session_class=_AsyncSyncSession,
+            autoflush=False,
+            # Attributes can't be loaded implicitly under asyncio
+            expire_on_commit=False,
+            bind=self.engine), scopefunc=current_task)
+        if assign_global:
+            _async_db = self
+
+    def init(self):
+        _init_timestamps()
+        event.listen(_AsyncSyncSession, 'after_begin', _set_statement_timeout)
+        _init_metrics(self.engine.sync_engine)
+
+    async def create(self):
+        async with self.engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+
+    @asynccontextmanager
+    async def scope(self):
+        """Yields the current task's session, and removes it afterwards."""
+        try:
+            yield self.session
+        finally:
+            await self.session.remove()
+
+    async def dispose(self):
+        await self.engine.dispose()
+
 def alembic(site, alembic_module, argv=None):
     """
     Automatically rigs up the Alembic config and shells out to it.
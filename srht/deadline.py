@@ -0,0 +1,81 @@
+"""
+srht.deadline limits how long a request may run. Requests are given
+[sr.ht]request-deadline milliseconds (no limit if unset), which views may
+override with the deadline decorator:
+
+    @app.route("/search")
+    @deadline(5000)
+    def search(): ...
+
+The time remaining is applied to SQL statements as the transaction's
+statement_timeout, and to outbound HTTP requests via http_timeout. Requests
+which run out of time are answered with 503 Service Unavailable.
+"""
+from flask import current_app, g, has_request_context, request
+from srht.config import cfgi
+from timeit import default_timer
+
+class DeadlineExceeded(Exception):
+    pass
+
+def deadline(ms):
+    """
+    Sets the deadline of a view in milliseconds, or None for no deadline.
+    Apply this directly to the view function.
+    """
+    def wrap(f):
+        f._srht_deadline = ms
+        return f
+    return wrap
+
+def begin_request():
+    """Starts the deadline of the current request."""
+    view = current_app.view_functions.get(request.endpoint)
+    ms = getattr(view, "_srht_deadline", False)
+    if ms is False:
+        ms = cfgi("sr.ht", "request-deadline", default=None)
+    if ms:
+        g._srht_deadline = default_timer() + ms / 1000
+
+def remaining():
+    """
+    Returns the seconds left until the current request's deadline, or None
+    if it has none.
+    """
+    if not has_request_context():
+        return None
+    end = g.get("_srht_deadline")
+    if end is None:
+        return None
+    return end - default_timer()
+
+def exceeded():
+    """Returns true if the current request has run out of time."""
+    left = remaining()
+    return left is not None and left <= 0
+
+def http_timeout(timeout=None):
+    """
+    Returns the timeout in seconds to use for an outbound HTTP request: the
+    given timeout, limited to the time left for the current request. Raises
+    DeadlineExceeded if there is none left.
+    """
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceeded()
+    return left if timeout is None else min(timeout, left)
+
+def statement_timeout():
+    """
+    Returns the statement_timeout in milliseconds to use for the current
+    request's transactions, or None. Raises DeadlineExceeded if there is no
+    time left.
+    """
+    left = remaining()
+    if left is None:
+        return None
+    if left <= 0:
+        raise DeadlineExceeded()
+    return max(int(left * 1000), 1)
@@ -1,4 +1,7 @@
+from srht import nplusone
 from srht.config import cfg, cfgi
+from srht.static import load_manifest
+import mimetypes
 import os.path
 import sys
 import argparse
@@ -16,6 +19,50 @@ def configure_static_folder(app, static_folder=_auto_set_static_folder):
         else:
             app.static_folder = static_folder
 
+class HashedStaticMiddleware:
+    """
+    Serves the content-hashed static assets listed in the static manifest
+    with immutable caching, preferring precompressed copies of each asset if
+    the client accepts them.
+    """
+    def __init__(self, app, static_folder):
+        self.app = app
+        self.static_folder = static_folder
+        self.assets = {
+            hashed: path
+            for path, hashed in load_manifest(static_folder).items()
+        }
+
+    def _path(self, resource):
+        # Resources are listed as static/..., relative to the static folder
+        return os.path.join(self.static_folder, resource.split("/", 1)[1])
+
+    def __call__(self, environ, start_response):
+        from werkzeug.datastructures import Headers
+        from werkzeug.wsgi import wrap_file
+
+        resource = environ.get("PATH_INFO", "").lstrip("/")
+        if resource not in self.assets:
+            return self.app(environ, start_response)
+        path = self._path(resource)
+        if not os.path.exists(path):
+            path = self._path(self.assets[resource])
+
+        headers = Headers()
+        mimetype, _ = mimetypes.guess_type(self.assets[resource])
+        headers["Content-Type"] = mimetype or "application/octet-stream"
+        headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        headers["Vary"] = "Accept-Encoding"
+        accept = environ.get("HTTP_ACCEPT_ENCODING", "")
+        for encoding, suffix in [("br", ".br"), ("gzip", ".gz")]:
+            if encoding in accept and os.path.exists(path + suffix):
+                path += suffix
+                headers["Content-Encoding"] = encoding
+                break
+        headers["Content-Length"] = str(os.path.getsize(path))
+        start_response("200 OK", headers.to_wsgi_list())
+        return wrap_file(environ, open(path, "rb"))
+
 def configure_static_arguments(parser):
     parser.add_argument(
         '--static',
@@ -30,9 +77,10 @@ def configure_static_serving(app, args):
             from werkzeug.wsgi import SharedDataMiddleware
 
         print("Serving static assets from: {}".format(app.static_folder))
-        app.wsgi_app = SharedDataMiddleware(app.wsgi_app, {
-            '/static': app.static_folder
-        })
+        app.wsgi_app = HashedStaticMiddleware(
+            SharedDataMiddleware(app.wsgi_app, {
+                '/static': app.static_folder
+            }), app.static_folder)
 
 def build_parser(app):
     parser = argparse.ArgumentParser(
@@ -46,6 +94,8 @@ def run_app(app):
             debug=True)
 
 def run_service(app, *, static_folder=_auto_set_static_folder):
+    nplusone.configure(rate=1, raise_on_detect=True)
+    app.server_timing = True
     configure_static_folder(app, static_folder)
     parser = build_parser(app)
     configure_static_arguments(parser)
@@ -5,15 +5,35 @@ from email.utils import formataddr, formatdate, make_msgid, parseaddr
 from flask import request, has_request_context, has_app_context, current_app
 from srht.crypto import encrypt_request_authorization
 from srht.config import cfg, cfgi, cfgb, get_origin
+from werkzeug.local import LocalProxy
+from collections import deque
+from prometheus_client import Counter
+from time import monotonic
+import atexit
 import base64
+import hashlib
+import os
+import queue
 import smtplib
-import pgpy
 import requests
+import sys
+import threading
 import traceback
 
-site_key = cfg("mail", "pgp-privkey", default=None)
-if site_key:
-    site_key, _ = pgpy.PGPKey.from_file(site_key)
+_site_key = False
+
+def _load_site_key():
+    global _site_key
+    if _site_key is False:
+        path = cfg("mail", "pgp-privkey", default=None)
+        if path:
+            import pgpy
+            _site_key, _ = pgpy.PGPKey.from_file(path)
+        else:
+            _site_key = None
+    return _site_key
+
+site_key = LocalProxy(_load_site_key)
 smtp_host = cfg("mail", "smtp-host", default=None)
 smtp_port = cfgi("mail", "smtp-port", default=None)
 smtp_user = cfg("mail", "smtp-user", default=None)
@@ -24,7 +44,18 @@ error_to = cfg("mail", "error-to", default=None)
 error_from = cfg("mail", "error-from", default=None)
 meta_url = get_origin("meta.sr.ht")
 
+_metrics = type("metrics", tuple(), {
+    m.describe()[0].name: m
+    for m in [
+        Counter("exceptions", "Unhandled exceptions",
+            ["context", "exception"]),
+    ]
+})
+
+_reporter_lock = threading.Lock()
+
 def micalg_for(hash_alg):
+    import pgpy
     return {
         pgpy.constants.HashAlgorithm.MD5: "pgp-md5",
         pgpy.constants.HashAlgorithm.SHA1: "pgp-sha1",
@@ -90,6 +121,7 @@ def prepare_email(body, to, subject, encrypt_key=None, **headers):
             multipart[key] = headers[key]
         return multipart
     else:
+        import pgpy
         pubkey, _ = pgpy.PGPKey.from_blob(encrypt_key.replace('\r', '').encode())
         pgp_msg = pgpy.PGPMessage.new(multipart.as_string(unixfrom=False))
         if pubkey.get_uid(to):
@@ -135,10 +167,7 @@ def send_email(body, to, subject, encrypt_key=None, **headers):
     smtp.send_message(message, smtp_from, [to])
     smtp.quit()
 
-def mail_exception(ex, user=None, context=None):
-    if not error_to or not error_from:
-        print("Warning: no email configured for error emails")
-        return
+def _exception_report(ex, user=None, context=None):
     if has_app_context() and has_request_context():
         data = request.get_data() or b"(no request body)"
     else:
@@ -178,4 +207,151 @@ Current user:
             f"{request.method} {request.url}")
     else:
         subject = f"{ex.__class__.__name__}"
+    return subject, body
+
+def _unwrap(ex):
+    # Flask passes 500 handlers an InternalServerError wrapping the error
+    return getattr(ex, "original_exception", None) or ex
+
+def mail_exception(ex, user=None, context=None):
+    """Synchronously emails a report of the exception being handled."""
+    ex = _unwrap(ex)
+    if not error_to or not error_from:
+        print("Warning: no email configured for error emails")
+        return
+    subject, body = _exception_report(ex, user, context)
     send_email(body, error_to, subject, **{"From": error_from})
+
+def _fingerprint(ex):
+    tb = sys.exc_info()[2] or ex.__traceback__
+    frames = [(f.filename, f.name) for f in traceback.extract_tb(tb)]
+    key = repr((ex.__class__.__module__, ex.__class__.__name__, frames))
+    return hashlib.sha256(key.encode()).hexdigest()
+
+class _ErrorReporter:
+    """
+    Emails error reports from a background thread. Reports with the same
+    fingerprint are grouped for [mail]error-window seconds (default 60) and
+    sent as a single summary, and no more than [mail]error-rate-limit emails
+    (default 30) are sent per hour.
+    """
+    def __init__(self):
+        self.pid = os.getpid()
+        self.queue = queue.Queue(maxsize=1000)
+        self.lock = threading.Lock()
+        self.groups = dict()
+        self.sent = deque()
+        self.suppressed = 0
+        self.thread = threading.Thread(target=self.run,
+                name="srht-error-reporter", daemon=True)
+        self.thread.start()
+
+    def submit(self, fingerprint, subject, body, location):
+        try:
+            self.queue.put_nowait((fingerprint, subject, body, location))
+        except queue.Full:
+            with self.lock:
+                self.suppressed += 1
+
+    def run(self):
+        while True:
+            try:
+                report = self.queue.get(timeout=1)
+            except queue.Empty:
+                report = None
+            with self.lock:
+                if report:
+                    self.add(*report)
+                self.flush()
+
+    def add(self, fingerprint, subject, body, location):
+        group = self.groups.get(fingerprint)
+        if group is None:
+            self.groups[fingerprint] = group = {
+                "subject": subject,
+                "body": body,
+                "count": 0,
+                "started": monotonic(),
+                "locations": list(),
+            }
+        group["count"] += 1
+        if len(group["locations"]) < 10:
+            group["locations"].append(location)
+
+    def flush(self, force=False):
+        now = monotonic()
+        window = cfgi("mail", "error-window", default=60)
+        for fingerprint, group in list(self.groups.items()):
+            if force or now - group["started"] >= window:
+                del self.groups[fingerprint]
+                self.send(group)
+
+    def send(self, group):
+        now = monotonic()
+        while self.sent and now - self.sent[0] > 60 * 60:
+            self.sent.popleft()
+        if len(self.sent) >= cfgi("mail", "error-rate-limit", default=30):
+            self.suppressed += group["count"]
+            return
+        self.sent.append(now)
+
+        subject = group["subject"]
+        body = group["body"]
+        if group["count"] > 1:
+            subject = f"{subject} (x{group['count']})"
+            locations = "\n".join(group["locations"])
+            window = cfgi("mail", "error-window", default=60)
+            body = f"""This error occurred {group['count']} times in {window} seconds, at:
+
+{locations}
+
+The first occurrence follows.
+{body}"""
+        if self.suppressed:
+            body += f"""
+
+{self.suppressed} other error reports were dropped due to rate limits."""
+            self.suppressed = 0
+        try:
+            send_email(body, error_to, subject, **{"From": error_from})
+        except Exception:
+            print("Failed to send error report:")
+            traceback.print_exc()
+
+    def shutdown(self):
+        with self.lock:
+            while True:
+                try:
+                    self.add(*self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.flush(force=True)
+
+_reporter = None
+
+def report_exception(ex, user=None, context=None):
+    """
+    Reports the exception being handled without blocking on SMTP. The report
+    is emailed from a background thread, grouped with other occurrences of
+    the same error.
+    """
+    global _reporter
+    ex = _unwrap(ex)
+    _metrics.exceptions.labels(
+        context=context or (current_app.site if has_app_context() else ""),
+        exception=ex.__class__.__name__,
+    ).inc()
+    if not error_to or not error_from:
+        print("Warning: no email configured for error emails")
+        return
+    subject, body = _exception_report(ex, user, context)
+    if has_request_context():
+        location = f"{request.method} {request.url}"
+    else:
+        location = context or "(no request)"
+    with _reporter_lock:
+        if _reporter is None or _reporter.pid != os.getpid():
+            # Threads do not survive fork, start one for this process
+            _reporter = _ErrorReporter()
+            atexit.register(_reporter.shutdown)
+    _reporter.submit(_fingerprint(ex), subject, body, location)
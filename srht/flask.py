@@ -1,20 +1,32 @@
-DATE_FORMAT = "%Y-%m-%dT%H:%M:%S+00:00"
-from bs4 import BeautifulSoup
 from flask import Flask, Response, request, url_for, render_template, redirect
 from flask import Blueprint, current_app, g, abort, session as flask_session
 from flask import make_response
-from enum import Enum
-from srht.config import cfg, cfgi, cfgkeys, config, get_origin, get_global_domain
+from collections import OrderedDict
+from srht.codec import DATE_FORMAT, date_handler
+from srht import codec
+from srht.config import cfg, cfgi, cfgb, cfgkeys, get_origin, get_global_domain
+from srht.config import get_network
 from srht.crypto import fernet
-from srht.email import mail_exception
-from srht.database import db
-from srht.markdown import markdown
+from srht.email import report_exception
+from srht.icons import fa_license, load_icons, sprite_sheet
+from srht.database import db, primary_cookie, query_count
+from srht.database import begin_request, end_request, Explain
+from srht import deadline
+from srht.pagecache import CacheExtension
+from srht.rtl import annotate_rtl, has_rtl
+from srht.slowlog import log_if_slow
+from srht.static import hashed_name, load_manifest
+from srht.timing import TimedTemplate, server_timing, timings
 from srht.validation import Validation
 from datetime import datetime, timedelta
 from jinja2 import FileSystemLoader, ChoiceLoader, pass_context
+from jinja2 import FileSystemBytecodeCache, MemcachedBytecodeCache
+from jinja2 import TemplateError
+from jinja2.utils import LRUCache
 from markupsafe import Markup, escape
-from prometheus_client import Histogram, CollectorRegistry, REGISTRY, make_wsgi_app
+from prometheus_client import Counter, Histogram, CollectorRegistry, REGISTRY, make_wsgi_app
 from prometheus_client.multiprocess import MultiProcessCollector
+from time import time
 from timeit import default_timer
 from urllib.parse import urlparse, quote_plus
 from werkzeug.local import LocalProxy
@@ -25,20 +37,17 @@ try:
 except ImportError:
     from werkzeug.wsgi import DispatcherMiddleware
 import binascii
-import bleach
-import decimal
 import hashlib
-import humanize
 import inspect
 import json
 import locale
 import os
 import psycopg2.errors
+import requests.exceptions
 import secrets
 import sqlalchemy.exc
 import sqlalchemy.orm.exc
 import sys
-import unicodedata
 from functools import update_wrapper
 
 class NamespacedSession:
@@ -67,23 +76,8 @@ class NamespacedSession:
 _session = NamespacedSession()
 session = LocalProxy(lambda: _session)
 
-humanize.time._now = lambda: datetime.utcnow()
-
-try:
-    locale.setlocale(locale.LC_ALL, 'en_US')
-except:
-    pass
-
-def date_handler(obj):
-    if hasattr(obj, 'strftime'):
-        return obj.strftime(DATE_FORMAT)
-    if isinstance(obj, decimal.Decimal):
-        return "{:.2f}".format(obj)
-    if isinstance(obj, Enum):
-        return obj.name
-    return obj
-
 def datef(d):
+    import humanize
     if not d:
         return 'Never'
     if isinstance(d, timedelta):
@@ -93,20 +87,17 @@ def datef(d):
         d.strftime('%Y-%m-%d %H:%M:%S UTC'),
         humanize.naturaltime(d)))
 
-icon_cache = {}
-
 def icon(i, cls=""):
-    if i in icon_cache:
-        svg = icon_cache[i]
+    if current_app.icon_sprites:
+        svg = (f'<svg><use href="/icons.{current_app.icon_sprite_digest}.svg'
+            f'#icon-{i}"/></svg>')
         return Markup(f'<span class="icon icon-{i} {cls}" aria-hidden="true">{svg}</span>')
-    fa_license = """<!--
-        Font Awesome Free 5.3.1 by @fontawesome - https://fontawesome.com
-        License - https://fontawesome.com/license/free (Icons: CC BY 4.0, Fonts: SIL OFL 1.1, Code: MIT License)
-    -->"""
-    path = os.path.join(current_app.mod_path, 'static', 'icons', i + '.svg')
-    with open(path) as f:
-        svg = f.read()
-    icon_cache[i] = svg
+    svg = current_app.icons.get(i)
+    if svg is None:
+        # Not preloaded, e.g. added after the app started
+        path = os.path.join(current_app.mod_path, 'static', 'icons', i + '.svg')
+        with open(path) as f:
+            svg = current_app.icons[i] = f.read().strip()
     if g and "fa_license" not in g:
         svg += fa_license
         g.fa_license = True
@@ -127,6 +118,16 @@ def pagination(context):
     template = context.environment.get_template("pagination.html")
     return Markup(template.render(**context.parent))
 
+def is_deadline_error(ex):
+    """Returns true if the exception was caused by the request's deadline."""
+    if isinstance(ex, deadline.DeadlineExceeded):
+        return True
+    if isinstance(ex, sqlalchemy.exc.OperationalError):
+        return isinstance(ex.orig, psycopg2.errors.QueryCanceled)
+    if isinstance(ex, requests.exceptions.Timeout):
+        return deadline.exceeded()
+    return False
+
 def csrf_token():
     if '_csrf_token_v2' not in flask_session:
         flask_session['_csrf_token_v2'] = binascii.hexlify(os.urandom(64)).decode()
@@ -146,46 +147,290 @@ def csrf_bypass(f):
         _csrf_bypass_views.update([view])
     return f
 
-def paginate_query(query, results_per_page=15):
-    page = request.args.get("page")
-    total_results = query.count()
-    total_pages = total_results // results_per_page + 1
-    if total_results % results_per_page == 0:
-        total_pages -= 1
-    if page is not None:
+def _unfiltered_table(statement):
+    # The table which a query reads every row of, if it does so
+    froms = statement.froms
+    if len(froms) != 1 or not isinstance(froms[0], sqlalchemy.Table):
+        return None
+    for attr in ["whereclause", "_whereclause", "_having",
+            "_limit_clause", "_offset_clause"]:
+        if getattr(statement, attr, None) is not None:
+            return None
+    for attr in ["_group_by_clauses", "_group_by_clause", "_having_criteria"]:
+        if len(getattr(statement, attr, ())):
+            return None
+    if statement._distinct:
+        return None
+    return froms[0]
+
+def _count_estimate(query):
+    statement = query.statement
+    table = _unfiltered_table(statement)
+    if table is not None:
+        # The planner's estimate of the table's size
+        rows = db.session.execute(sqlalchemy.select(
+            [sqlalchemy.column("reltuples")],
+        ).select_from(sqlalchemy.table("pg_class")).where(
+            sqlalchemy.column("oid") ==
+                sqlalchemy.func.to_regclass(table.fullname),
+        )).scalar()
+        if rows is not None and rows >= 0: # -1 if never analyzed
+            return int(rows)
+    # The EXPLAIN runs in a savepoint lest a failure abort the request's
+    # transaction
+    with db.session.begin_nested():
+        plan = db.session.execute(Explain(statement)).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+def count_query(query, total="exact", ttl=60):
+    """
+    Counts the results of a query. total may be one of:
+
+    "exact": runs SELECT count(*)
+    "cached": as exact, but caches the result in redis for ttl seconds
+    "estimate": uses the table's estimated size (pg_class.reltuples) for
+        unfiltered queries, or else the query planner's row estimate
+        (EXPLAIN)
+    None: does not count the results and returns None
+    """
+    if total is None:
+        return None
+    if total == "estimate":
         try:
-            page = int(page) - 1
-            query = query.offset(page * results_per_page)
-        except:
+            return _count_estimate(query)
+        except Exception:
+            # The planner could not be consulted
+            total = "exact"
+    if total == "cached":
+        from srht.cache import get_cache, set_cache
+        compiled = query.statement.compile(dialect=db.engine.dialect)
+        key = hashlib.sha256((str(compiled) +
+            repr(sorted(compiled.params.items()))).encode()).hexdigest()
+        key = f"srht.pagination.count.{key}"
+        count = get_cache(key)
+        if count is not None:
+            return int(count)
+        count = query.count()
+        set_cache(key, ttl, str(count))
+        return count
+    if total != "exact":
+        raise ValueError(f"Unknown pagination total mode {total}")
+    return query.count()
+
+def _parse_cursor(key, value):
+    try:
+        if key.type.python_type is int:
+            return int(value)
+    except (NotImplementedError, ValueError):
+        abort(400)
+    return value
+
+def _paginate_keyset(query, results_per_page, key, key_desc):
+    after = request.args.get("after")
+    before = request.args.get("before")
+    try:
+        page = max(int(request.args.get("page", 1)), 1)
+    except ValueError:
+        page = 1
+    if after is not None:
+        after = _parse_cursor(key, after)
+        query = query.filter(key < after if key_desc else key > after)
+    elif before is not None:
+        before = _parse_cursor(key, before)
+        query = query.filter(key > before if key_desc else key < before)
+    # The results are ordered by the key alone, or the cursors won't work
+    query = query.order_by(None)
+    if before is not None:
+        # Walk backwards from the cursor, then restore the usual order
+        query = query.order_by(key.asc() if key_desc else key.desc())
+    else:
+        query = query.order_by(key.desc() if key_desc else key.asc())
+    results = query.limit(results_per_page + 1).all()
+    has_more = len(results) > results_per_page
+    results = results[:results_per_page]
+    if before is not None:
+        results.reverse()
+        has_prev = has_more
+        has_next = True
+    else:
+        has_prev = after is not None
+        has_next = has_more
+    if not has_prev:
+        page = 1
+    cursor = lambda r: getattr(r, key.key)
+    return results, {
+        "page": page,
+        "has_prev": has_prev,
+        "has_next": has_next,
+        "prev_cursor": cursor(results[0]) if has_prev and results else None,
+        "next_cursor": cursor(results[-1]) if has_next and results else None,
+    }
+
+def paginate_query(query, results_per_page=15,
+        key=None, key_desc=True, total="exact", total_ttl=60):
+    """
+    Paginates an SQLAlchemy query for use with the pagination.html template.
+
+    By default, pages are selected with ?page=<n> using OFFSET. If a key
+    column is given (which must be unique, generally the primary key), keyset
+    pagination is used instead: the results are ordered by the key
+    (descending, unless key_desc=False) and pages are selected by the
+    ?after=<key> and ?before=<key> cursors, such that deep pages cost the
+    same as the first page.
+
+    total controls how the total number of results is obtained, see
+    count_query. If the total is not exact, the number of pages is an
+    estimate; if it is None, only the current page number is shown.
+    """
+    total_results = count_query(query, total, total_ttl)
+    if key is not None:
+        results, pagination = _paginate_keyset(
+                query, results_per_page, key, key_desc)
+        page = pagination["page"]
+    else:
+        page = request.args.get("page")
+        if page is not None:
+            try:
+                page = int(page) - 1
+                query = query.offset(page * results_per_page)
+            except:
+                page = 0
+        else:
             page = 0
+        if page < 0:
+            abort(400)
+        limit = results_per_page if total == "exact" else results_per_page + 1
+        results = query.limit(limit).all()
+        has_next = len(results) > results_per_page
+        results = results[:results_per_page]
+        page = page + 1
+        pagination = {
+            "page": page,
+            "has_prev": page > 1,
+        }
+        if total != "exact":
+            pagination["has_next"] = has_next
+    if total_results is None:
+        total_pages = None
     else:
-        page = 0
-    if page < 0:
-        abort(400)
-    query = query.limit(results_per_page).all()
-    return query, {
+        total_pages = total_results // results_per_page + 1
+        if total_results % results_per_page == 0:
+            total_pages -= 1
+        if total != "exact":
+            total_pages = max(total_pages, page)
+    return results, {
+        **pagination,
         "total_pages": total_pages,
-        "page": page + 1,
-        "total_results": total_results
+        "total_results": total_results,
+        "estimated_total": total == "estimate",
     }
 
 def inject_rtl_direction(resp):
-    if resp.mimetype == 'text/html':
-        html_doc = resp.data.decode('utf8')
-        soup = BeautifulSoup(html_doc, 'html.parser')
-        if not soup.body:
-            return resp
-        for el in soup.body.find_all():
-            if el.name == 'input' or el.name == 'textarea':
-                el.attrs['dir'] = "auto"
-                continue
-            for ch in el.text:
-                if unicodedata.bidirectional(ch) in ('R', 'AL'):
-                    el.attrs['dir'] = "auto"
-                    break
-        resp.data = soup.encode('utf8')
+    """
+    Adds dir="auto" to elements of HTML responses which contain right-to-left
+    text, and to all inputs and textareas. Set [sr.ht]rtl-direction=no to
+    disable.
+    """
+    if resp.mimetype != 'text/html' or resp.is_streamed:
+        return resp
+    if not cfgb("sr.ht", "rtl-direction", default=True):
+        return resp
+    data = resp.get_data()
+    rtl = has_rtl(data)
+    if not rtl and b"<input" not in data and b"<textarea" not in data:
+        return resp
+    html_doc = annotate_rtl(data.decode('utf8'), rtl=rtl)
+    if html_doc is not None:
+        resp.set_data(html_doc.encode('utf8'))
     return resp
 
+_login_cookie_cache = OrderedDict()
+_login_cookie_cache_size = 1024
+
+def decrypt_login_cookie(cookie):
+    """
+    Decrypts the unified login cookie, caching the results for recently seen
+    cookies by the digest of their ciphertext.
+    """
+    key = hashlib.sha256(cookie.encode()).digest()
+    user_info = _login_cookie_cache.get(key)
+    if user_info is not None:
+        try:
+            _login_cookie_cache.move_to_end(key)
+        except KeyError:
+            pass
+        return user_info
+    user_info = codec.loads(fernet.decrypt(cookie.encode()))
+    _login_cookie_cache[key] = user_info
+    while len(_login_cookie_cache) > _login_cookie_cache_size:
+        try:
+            _login_cookie_cache.popitem(last=False)
+        except KeyError:
+            break
+    return user_info
+
+def conditional_get(*records, etag=None, last_modified=None):
+    """
+    Supplies the validators for the current request up front, before any
+    expensive queries or rendering are done. If the client already has this
+    version of the resource (per If-None-Match or If-Modified-Since), aborts
+    with 304 Not Modified.
+
+    If records are given, the ETag and Last-Modified date are derived from
+    their updated columns, otherwise provide etag and/or last_modified. The
+    ETag always varies by the current user.
+    """
+    if records:
+        if last_modified is None:
+            last_modified = max(r.updated for r in records)
+        if etag is None:
+            etag = ";".join(f"{r.__class__.__name__}:{r.id}:"
+                    f"{r.updated.isoformat()}" for r in records)
+    if etag is not None:
+        from srht.oauth import current_user
+        user = current_user.username if current_user else ""
+        etag = hashlib.sha256(f"{user};{etag}".encode()).hexdigest()[:32]
+    if request.method not in ("GET", "HEAD"):
+        return
+    g.srht_etag = etag
+    g.srht_last_modified = last_modified
+
+    not_modified = False
+    if etag is not None and request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(etag)
+    elif last_modified is not None and request.if_modified_since:
+        since = request.if_modified_since.replace(tzinfo=None)
+        not_modified = last_modified.replace(microsecond=0) <= since
+    if not_modified:
+        resp = Response(status=304)
+        if etag is not None:
+            resp.set_etag(etag, weak=True)
+        if last_modified is not None:
+            resp.last_modified = last_modified
+        abort(resp)
+
+def add_validators(resp):
+    """
+    Adds ETag and Last-Modified headers to successful GET responses, and
+    answers with 304 Not Modified if the client already has this version.
+    Validators supplied with conditional_get are used if present, otherwise
+    a weak ETag is computed from the response body.
+    """
+    if request.method not in ("GET", "HEAD") or resp.status_code != 200:
+        return resp
+    if "srht_etag" in g or "srht_last_modified" in g:
+        if g.srht_etag is not None:
+            resp.set_etag(g.srht_etag, weak=True)
+        if g.srht_last_modified is not None:
+            resp.last_modified = g.srht_last_modified
+    elif resp.is_streamed or "ETag" in resp.headers:
+        return resp
+    else:
+        resp.add_etag(weak=True)
+    return resp.make_conditional(request)
+
 class ModifiedUnicodeConverter(UnicodeConverter):
     """Added ~ and ^ to safe URL characters, otherwise no changes."""
     def to_url(self, value):
@@ -197,6 +442,13 @@ class SrhtFlask(Flask):
         super().__init__(name, *args, **kwargs)
 
         self.site = site
+
+        import humanize
+        humanize.time._now = lambda: datetime.utcnow()
+        try:
+            locale.setlocale(locale.LC_ALL, 'en_US')
+        except:
+            pass
         if os.environ.get("prometheus_multiproc_dir"):
             self.metrics_registry = CollectorRegistry()
             MultiProcessCollector(self.metrics_registry)
@@ -211,6 +463,17 @@ class SrhtFlask(Flask):
                 Histogram("request_time", "Duration of HTTP requests", [
                     "method", "route", "status"
                 ]),
+                Histogram("request_component_time",
+                    "Time spent on each kind of work per HTTP request",
+                    ["route", "component"]),
+                Counter("page_cache_requests",
+                    "Page and fragment cache lookups", ["kind", "result"]),
+                Histogram("request_sql_queries",
+                    "Number of SQL queries per HTTP request", ["route"],
+                    buckets=[0, 1, 2, 5, 10, 20, 50, 100, 200, 500]),
+                Histogram("request_user_queries",
+                    "Number of SQL queries per HTTP request spent loading "
+                    "users", ["route"], buckets=[0, 1, 2, 5, 10]),
             ]
         })
 
@@ -231,6 +494,21 @@ class SrhtFlask(Flask):
             raise Exception("Can't find the module's path, how are you running the app???")
 
         self.mod_path = path
+        self.static_manifest = load_manifest(os.path.join(path, "static"))
+
+        self.icons = load_icons(
+            os.path.join(os.path.dirname(__file__), "static", "icons"),
+            os.path.join(path, "static", "icons"))
+        self.icon_sprites = cfgb("sr.ht", "icon-sprites", default=False)
+        if self.icon_sprites:
+            sheet, self.icon_sprite_digest = sprite_sheet(self.icons)
+
+            @self.route(f"/icons.{self.icon_sprite_digest}.svg",
+                    endpoint="srht_icon_sprites")
+            def icon_sprites():
+                return Response(sheet, mimetype="image/svg+xml", headers={
+                    "Cache-Control": "public, max-age=31536000, immutable",
+                })
         choices.append(FileSystemLoader(os.path.join(path, "templates")))
         choices.append(FileSystemLoader(os.path.join(
             os.path.dirname(__file__),
@@ -251,6 +529,9 @@ class SrhtFlask(Flask):
         self.jinja_env.globals['csrf_token'] = csrf_token
         self.jinja_loader = ChoiceLoader(choices)
         self.jinja_env.add_extension('jinja2.ext.do')
+        self.jinja_env.add_extension(CacheExtension)
+        self.jinja_env.template_class = TimedTemplate
+        self.configure_template_cache()
         self.secret_key = cfg("sr.ht", "service-key", default=
                 cfg("sr.ht", "secret-key", default=None))
         if self.secret_key is None:
@@ -258,6 +539,8 @@ class SrhtFlask(Flask):
 
         self.oauth_service = oauth_service
         self.oauth_provider = oauth_provider
+        # Off by default, as the timings reveal details of our internals
+        self.server_timing = cfgb("sr.ht", "server-timing", default=False)
 
         if self.oauth_service:
             from srht.oauth import oauth_blueprint
@@ -269,6 +552,15 @@ class SrhtFlask(Flask):
         # TODO: Remove
         self.no_csrf_prefixes = ['/api']
 
+        @self.before_request
+        def begin_query_stats():
+            begin_request(request.endpoint)
+            deadline.begin_request()
+
+        @self.teardown_request
+        def end_query_stats(err):
+            end_request()
+
         @self.before_request
         def _csrf_check():
             if request.method != 'POST':
@@ -297,6 +589,13 @@ class SrhtFlask(Flask):
 
         @self.errorhandler(500)
         def handle_500(e):
+            if is_deadline_error(e.original_exception):
+                if hasattr(db, 'session'):
+                    db.session.rollback()
+                if request.path.startswith("/api"):
+                    return { "errors": [ {
+                        "reason": "503 service unavailable" } ] }, 503
+                return render_template("unavailable.html"), 503
             if isinstance(e.original_exception, sqlalchemy.exc.InternalError):
                 e = e.original_exception.orig
                 if isinstance(e, psycopg2.errors.ReadOnlySqlTransaction):
@@ -311,7 +610,7 @@ class SrhtFlask(Flask):
                         user = f"{current_user.canonical_name} " + \
                                 f"<{current_user.email}>"
                     db.session.close()
-                mail_exception(e, user=user)
+                report_exception(e, user=user)
             except Exception as e2:
                 # shit shit
                 raise e2.with_traceback(e2.__traceback__)
@@ -354,14 +653,13 @@ class SrhtFlask(Flask):
                 'coalesce_search_terms': coalesce_search_terms,
             }
             try:
-                from srht.oauth import current_user
-                user_class = (current_user._get_current_object().__class__
-                        if current_user else None)
+                from srht.oauth import current_user, load_user, LazyUser
+                user = current_user._get_current_object()
+                if user and not isinstance(user, LazyUser):
+                    user = load_user(user.__class__, user.id)
                 ctx = {
                     **ctx,
-                    'current_user': (user_class.query
-                        .filter(user_class.id == current_user.id)
-                    ).one_or_none() if current_user else None,
+                    'current_user': user if user else None,
                 }
             except sqlalchemy.orm.exc.DetachedInstanceError:
                 pass # Can happen while cleaning up from 500 errors
@@ -384,22 +682,42 @@ class SrhtFlask(Flask):
 
         @self.template_filter()
         def md(text):
+            from srht.markdown import markdown
             return markdown(text)
 
         @self.template_filter()
         def extended_md(text, baselevel=1):
+            from srht.markdown import markdown
             return markdown(text, baselevel)
 
         @self.before_request
         def get_session_cookie():
-            # TODO: We could probably speed things up by skipping the
-            # round-trip until we actually need any user info which isn't
-            # present in the user's info cookie
             cookie = request.cookies.get("sr.ht.unified-login.v1")
             if not cookie:
                 return
-            user_info = json.loads(fernet.decrypt(cookie.encode()).decode())
-            g.current_user = self.oauth_service.lookup_user(user_info["name"])
+            user_info = decrypt_login_cookie(cookie)
+            # The user is only looked up once we need something which isn't
+            # present in the user's info cookie
+            from srht.oauth import cache_user, count_user_queries, LazyUser
+            g.current_user = LazyUser(user_info, lambda username:
+                    cache_user(count_user_queries(
+                        self.oauth_service.lookup_user, username)))
+
+        if cfgb("sr.ht", "conditional-get", default=True):
+            # Registered before track_request so that this runs after it
+            self.after_request(add_validators)
+
+        @self.after_request
+        def mark_primary_window(resp):
+            # Keep this user's requests on the primary for a little while
+            # after a write, in case the replicas have yet to catch up
+            if getattr(db, "replicas", None) and \
+                    request.method not in ("GET", "HEAD") and \
+                    resp.status_code < 400:
+                window = db.replica_write_window
+                resp.set_cookie(primary_cookie, str(time() + window),
+                        max_age=window, httponly=True)
+            return resp
 
         @self.before_request
         def begin_track_request():
@@ -409,19 +727,94 @@ class SrhtFlask(Flask):
         def track_request(resp):
             if not hasattr(request, "_srht_start_time"):
                 return resp
+            total = max(default_timer() - request._srht_start_time, 0)
             self.metrics.request_time.labels(
                 method=request.method,
                 route=request.endpoint,
                 status=resp.status_code,
-            ).observe(max(default_timer() - request._srht_start_time, 0))
+            ).observe(total)
+            for component, (_, duration) in timings().items():
+                self.metrics.request_component_time.labels(
+                    route=request.endpoint,
+                    component=component,
+                ).observe(duration)
+            from srht.oauth import user_query_count
+            user_queries = user_query_count()
+            if self.server_timing:
+                resp.headers["Server-Timing"] = (server_timing(total) +
+                        f', users;desc="User queries ({user_queries})"')
+            log_if_slow(self.site, request.method, request.endpoint,
+                    request.path, resp.status_code, total)
+            self.metrics.request_sql_queries.labels(
+                route=request.endpoint,
+            ).observe(query_count())
+            self.metrics.request_user_queries.labels(
+                route=request.endpoint,
+            ).observe(user_queries)
             return inject_rtl_direction(resp)
 
+    def configure_template_cache(self):
+        """
+        Configures the Jinja bytecode cache from [sr.ht]template-cache, which
+        may be "redis" or the path to a cache directory. Setting
+        [sr.ht]template-auto-reload=no disables checking templates for
+        changes on disk once they have been loaded.
+        """
+        cache = cfg("sr.ht", "template-cache", default=None)
+        if cache == "redis":
+            from srht.redis import redis
+            # redis-py's get/set are compatible with the memcached interface
+            self.jinja_env.bytecode_cache = MemcachedBytecodeCache(redis,
+                    prefix=f"srht.jinja2.{self.site}.", timeout=60 * 60 * 24)
+        elif cache:
+            os.makedirs(cache, exist_ok=True)
+            self.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache,
+                    pattern=f"__{self.site}_%s.cache")
+
+        auto_reload = cfgb("sr.ht", "template-auto-reload", default=None)
+        if auto_reload is not None:
+            self.config["TEMPLATES_AUTO_RELOAD"] = auto_reload
+            self.jinja_env.auto_reload = auto_reload
+
+    def precompile_templates(self):
+        """
+        Loads and compiles every template which the app can find, so that
+        this is not done on the first request which uses each one. Call this
+        once all template filters and globals are registered, e.g. from
+        gunicorn's post_worker_init hook. Returns the number of templates
+        compiled.
+        """
+        names = self.jinja_env.list_templates(extensions=["html", "xml", "txt"])
+        cache = self.jinja_env.cache
+        if isinstance(cache, LRUCache) and cache.capacity < len(names):
+            # Make room for every template, lest precompiling evict them
+            self.jinja_env.cache = LRUCache(len(names) * 2)
+        compiled = 0
+        for name in names:
+            try:
+                self.jinja_env.get_template(name)
+                compiled += 1
+            except TemplateError as ex:
+                print(f"Warning: unable to precompile {name}: {ex}")
+        return compiled
+
+    def preload(self):
+        """
+        Does the start-up work which would otherwise be deferred until the
+        first request: compiling templates, building the markdown sanitizer
+        and loading keys. When gunicorn preloads the app, this is done once
+        in the master and shared with the workers.
+        """
+        from srht import crypto, markdown
+        crypto._load_keys()
+        self.precompile_templates()
+
     def make_response(self, rv):
         # Converts responses from dicts to JSON response objects
         response = None
 
         def jsonify_wrap(obj):
-            jsonification = json.dumps(obj, default=date_handler)
+            jsonification = codec.dumps(obj)
             return Response(jsonification, mimetype='application/json')
 
         if isinstance(rv, tuple) and \
@@ -445,7 +838,7 @@ class SrhtFlask(Flask):
             else:
                 # Set user info cookie
                 user_info = g.current_user.to_dict(first_party=True)
-                user_info = json.dumps(user_info)
+                user_info = codec.dumps(user_info)
                 response.set_cookie(cookie_key,
                         fernet.encrypt(user_info.encode()).decode(),
                         domain=global_domain,
@@ -456,28 +849,18 @@ class SrhtFlask(Flask):
 
     def static_resource(self, path):
         """
-        Given /example.ext, hashes the file and returns /example.hash.ext
+        Given /example.ext, returns /example.hash.ext from the static manifest
         """
-        if not hasattr(self, "static_cache"):
-            self.static_cache = dict()
-        if path in self.static_cache:
-            return self.static_cache[path]
-        sha256 = hashlib.sha256()
-        with open(os.path.join(self.mod_path, path), "rb") as f:
-            sha256.update(f.read())
-        path, ext = os.path.splitext(path)
-        self.static_cache[path] = f"{path}.{sha256.hexdigest()[:8]}{ext}"
-        return self.static_cache[path]
+        resource = self.static_manifest.get(path)
+        if resource is None:
+            # Not known to the manifest, e.g. added after the app started
+            with open(os.path.join(self.mod_path, path), "rb") as f:
+                resource = hashed_name(path, f.read())
+            self.static_manifest[path] = resource
+        return resource
 
     def get_network(self):
-        return [
-                s for s in config
-                if s.endswith(".sr.ht") and s not in [
-                    "paste.sr.ht",
-                    "pages.sr.ht",
-                    "dispatch.sr.ht",
-                ]
-            ]
+        return get_network()
 
 def cross_origin(f):
     """
@@ -8,6 +8,7 @@ from pygments.formatters import HtmlFormatter
 from pygments.lexers import JsonLexer
 from srht.gql_lexer import GraphqlLexer
 from srht.config import get_origin, cfg
+from srht.deadline import http_timeout
 from srht.oauth import loginrequired
 from srht.validation import Validation
 from urllib.parse import urlparse
@@ -25,7 +26,8 @@ def execute_gql(query):
     r = requests.post(f"{origin}/query",
             cookies=request.cookies,
             headers={"Content-Type": "application/json"},
-            json={"query": query})
+            json={"query": query},
+            timeout=http_timeout())
     j = json.dumps(r.json(), indent=2)
     lexer = JsonLexer()
     formatter = HtmlFormatter()
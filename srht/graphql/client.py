@@ -1,9 +1,11 @@
-import json
 import requests
 from datetime import datetime
 from flask import request, has_request_context
+from srht import codec
 from srht.config import get_origin, cfg
 from srht.crypto import encrypt_request_authorization
+from srht.deadline import http_timeout
+from srht.timing import timed
 
 DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
 
@@ -71,6 +73,19 @@ class GraphQLOperation:
                 **encrypt_request_authorization(user=user, client_id=client_id),
             }
 
+        with timed("http"):
+            r = self._post(origin, headers)
+
+        resp = codec.loads(r.content)
+        if r.status_code != 200 or "errors" in resp:
+            if valid is None:
+                raise GraphQLError(resp)
+            else:
+                _copy_errors(valid, resp)
+                return resp.get("data")
+        return resp["data"]
+
+    def _post(self, origin, headers):
         if len(self.uploads) > 0:
             files = {}
             for i, upload in enumerate(self.uploads):
@@ -78,30 +93,27 @@ class GraphQLOperation:
 
             r = requests.post(f"{origin}/query",
                     headers=headers,
+                    timeout=http_timeout(),
                     files={
-                        'operations': (None, json.dumps({
+                        'operations': (None, codec.dumps({
                             "query": self.query,
                             "variables": self.variables,
                         })),
-                        'map': (None, json.dumps(self.map)),
+                        'map': (None, codec.dumps(self.map)),
                         **files,
                     })
         else:
             r = requests.post(f"{origin}/query",
-                    headers=headers,
-                    json={
+                    headers={
+                        **headers,
+                        "Content-Type": "application/json",
+                    },
+                    timeout=http_timeout(),
+                    data=codec.dumps({
                         "query": self.query,
                         "variables": self.variables,
-                    })
-
-        resp = r.json()
-        if r.status_code != 200 or "errors" in resp:
-            if valid is None:
-                raise GraphQLError(resp)
-            else:
-                _copy_errors(valid, resp)
-                return resp.get("data")
-        return resp["data"]
+                    }).encode())
+        return r
 
 def gql_time(time):
     """
@@ -0,0 +1,52 @@
+"""
+srht.icons loads the SVG icons used by the icon() template helper, and builds
+an SVG sprite sheet from them.
+"""
+from srht.static import _hashed
+import hashlib
+import os
+import re
+
+fa_license = """<!--
+        Font Awesome Free 5.3.1 by @fontawesome - https://fontawesome.com
+        License - https://fontawesome.com/license/free (Icons: CC BY 4.0, Fonts: SIL OFL 1.1, Code: MIT License)
+    -->"""
+
+_svg = re.compile(r"<svg([^>]*)>(.*)</svg>", re.DOTALL)
+_view_box = re.compile(r"""viewBox=["']([^"']*)["']""")
+
+def load_icons(*paths):
+    """
+    Loads every SVG icon from the given directories into a dict keyed by icon
+    name. Icons in later directories take precedence.
+    """
+    icons = dict()
+    for path in paths:
+        if not os.path.isdir(path):
+            continue
+        for name in sorted(os.listdir(path)):
+            if not name.endswith(".svg"):
+                continue
+            if _hashed.search(name):
+                continue # A copy written by srht.static.build_manifest
+            with open(os.path.join(path, name)) as f:
+                icons[name[:-len(".svg")]] = f.read().strip()
+    return icons
+
+def sprite_sheet(icons):
+    """
+    Builds an SVG sprite sheet with a <symbol id="icon-name"> for each icon.
+    Returns a tuple of the sheet and its digest.
+    """
+    symbols = []
+    for name, svg in sorted(icons.items()):
+        match = _svg.search(svg)
+        if not match:
+            continue
+        attrs, body = match.groups()
+        view_box = _view_box.search(attrs)
+        view_box = f' viewBox="{view_box.group(1)}"' if view_box else ""
+        symbols.append(f'<symbol id="icon-{name}"{view_box}>{body}</symbol>')
+    sheet = ('<svg xmlns="http://www.w3.org/2000/svg">' + fa_license +
+            "".join(symbols) + "</svg>")
+    return sheet, hashlib.sha256(sheet.encode()).hexdigest()[:8]
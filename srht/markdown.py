@@ -10,6 +10,7 @@ import bleach
 import html
 import mistletoe as m
 from mistletoe.span_token import SpanToken, RawText
+from srht.timing import timed_function
 import re
 
 SRHT_MARKDOWN_VERSION = 15
@@ -209,6 +210,7 @@ def add_noopener(html):
         a['rel'] = 'nofollow noopener'
     return str(soup)
 
+@timed_function("markdown")
 def markdown(text, baselevel=1, link_prefix=None, with_styles=True):
     text = text.replace("\r\n", "\n") # https://github.com/miyuchina/mistletoe/issues/124
     with SrhtRenderer(link_prefix, baselevel) as renderer:
@@ -0,0 +1,83 @@
+"""
+srht.nplusone detects requests which execute the same SQL statement (modulo
+parameters) many times over, which is usually a lazy-loaded relationship
+being walked in a loop.
+
+More than [sr.ht]n-plus-one-threshold executions of one statement (default
+10) in a request is reported. A fraction of requests given by
+[sr.ht]n-plus-one-sample-rate (default 0) are checked, and reports are
+counted in the sql_n_plus_one metric and logged. The development server
+checks every request and raises NPlusOneError instead.
+"""
+from flask import g, has_request_context, request
+from prometheus_client import Counter
+from srht.config import cfg, cfgi
+from srht.slowlog import fingerprint, normalize_sql
+import logging
+import os
+import random
+import traceback
+
+sample_rate = None # Overrides the configured sample rate
+raise_errors = False
+
+_metrics = type("metrics", tuple(), {
+    m.describe()[0].name: m
+    for m in [
+        Counter("sql_n_plus_one", "Repeated SQL statements detected in a "
+            "single request", ["route"]),
+    ]
+})
+
+_logger = logging.getLogger("srht.nplusone")
+
+# Frames from these paths are left out of stack excerpts
+_skip_paths = [
+    os.path.join("sqlalchemy", ""),
+    os.path.join("srht", "database.py"),
+    os.path.join("srht", "nplusone.py"),
+]
+
+class NPlusOneError(Exception):
+    pass
+
+def configure(rate=None, raise_on_detect=None):
+    """Overrides the configured sample rate and whether to raise errors."""
+    global sample_rate, raise_errors
+    if rate is not None:
+        sample_rate = rate
+    if raise_on_detect is not None:
+        raise_errors = raise_on_detect
+
+def _sampled():
+    sampled = g.get("_srht_n1_sampled")
+    if sampled is None:
+        rate = sample_rate
+        if rate is None:
+            rate = float(cfg("sr.ht", "n-plus-one-sample-rate", default=0))
+        sampled = g._srht_n1_sampled = (rate > 0 and random.random() < rate)
+    return sampled
+
+def _stack_excerpt(limit=8):
+    frames = [f for f in traceback.extract_stack()
+            if not any(p in f.filename for p in _skip_paths)]
+    return "".join(traceback.format_list(frames[-limit:]))
+
+def check_statement(statement):
+    """Counts an SQL statement executed by the current request."""
+    if not has_request_context() or not _sampled():
+        return
+    normalized = normalize_sql(statement)
+    key = fingerprint(normalized)
+    counts = g.setdefault("_srht_n1_counts", dict())
+    count = counts[key] = counts.get(key, 0) + 1
+    threshold = cfgi("sr.ht", "n-plus-one-threshold", default=10)
+    if count != threshold + 1:
+        return
+    route = request.endpoint
+    _metrics.sql_n_plus_one.labels(route=route).inc()
+    message = (f"Statement executed more than {threshold} times by "
+            f"{request.method} {route}: {normalized}\n{_stack_excerpt()}")
+    if raise_errors:
+        raise NPlusOneError(message)
+    _logger.warning(message)
@@ -20,7 +20,45 @@ Proxy for the currently authorzied user. The type is implementation defined,
 it's populated from the return value of AbstractOAuthService.get_user.
 """
 
+def cache_user(user):
+    """
+    Adds a user to the request-scoped user cache, so that later calls to
+    load_user return it without a database round-trip.
+    """
+    if user is not None:
+        g.setdefault("_srht_users", dict())[(user.__class__, user.id)] = user
+    return user
+
+def count_user_queries(loader, *args):
+    """
+    Calls loader with the given arguments, adding the SQL statements it
+    executes to the current request's user query count.
+    """
+    from srht.database import query_count
+    before = query_count()
+    try:
+        return loader(*args)
+    finally:
+        g.srht_user_queries = (user_query_count() +
+                query_count() - before)
+
+def user_query_count():
+    """
+    Returns the number of SQL statements the current request has executed
+    to load users.
+    """
+    return g.get("srht_user_queries", 0)
+
+def load_user(user_class, user_id):
+    """Loads a user by ID at most once per request."""
+    users = g.setdefault("_srht_users", dict())
+    key = (user_class, user_id)
+    if key not in users:
+        users[key] = count_user_queries(user_class.query.get, user_id)
+    return users[key]
+
 def login_user(user, set_cookie=False):
+    cache_user(user)
     g.current_user = user
     g.set_current_user = set_cookie
 
@@ -34,11 +72,15 @@ def freshen_user():
 def loginrequired(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
-        from srht.oauth import UserType
-        if not current_user:
+        from srht.oauth import UserType, LazyUser
+        user = current_user._get_current_object()
+        if isinstance(user, LazyUser):
+            # Account status is not taken from the login cookie
+            user = user._get_current_object()
+        if not user:
             return redirect(current_app.oauth_service.oauth_url(request.url))
-        elif current_user.user_type == UserType.suspended:
-            return f"Your account has been suspended for the following reason: {current_user.suspension_notice}. Contact support.", 401
+        elif user.user_type == UserType.suspended:
+            return f"Your account has been suspended for the following reason: {user.suspension_notice}. Contact support.", 401
         else:
             return f(*args, **kwargs)
     return wrapper
@@ -56,7 +98,7 @@ class OAuthError(Exception):
 
 from srht.oauth.client import OAuthClientMixin
 from srht.oauth.token import OAuthTokenMixin, ExternalOAuthTokenMixin
-from srht.oauth.user import UserMixin, UserType, ExternalUserMixin
+from srht.oauth.user import UserMixin, UserType, ExternalUserMixin, LazyUser
 
 from srht.oauth.blueprint import oauth_blueprint
 from srht.oauth.decorator import oauth
@@ -5,7 +5,7 @@ from srht.config import cfg, get_origin
 from srht.crypto import encrypt_request_authorization
 from srht.crypto import verify_encrypted_authorization
 from srht.database import db
-from srht.oauth import OAuthError, UserType
+from srht.oauth import OAuthError, UserType, cache_user, count_user_queries
 from srht.oauth.scope import OAuthScope
 from srht.validation import Validation
 import hashlib
@@ -113,14 +113,16 @@ def oauth(scopes):
                 return valid.error("Your OAuth token is not permitted to use " +
                     "this endpoint (needs {})".format(required), status=403)
 
-            if oauth_token.user.user_type == UserType.suspended:
+            user = cache_user(count_user_queries(
+                    lambda: oauth_token.user))
+            if user.user_type == UserType.suspended:
                 return valid.error("The authorized user's account has been " +
                     "suspended with the following notice: \n" +
-                    oauth_token.user.suspension_notice + "\n" +
+                    user.suspension_notice + "\n" +
                     "Contact support: " + cfg("sr.ht", "owner-email"),
                     status=403)
 
-            if oauth_token.user.user_type == UserType.unconfirmed:
+            if user.user_type == UserType.unconfirmed:
                 return valid.error("The authorized user's account has not " +
                     "been confirmed.", status=403)
 
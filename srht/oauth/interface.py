@@ -10,8 +10,10 @@ from srht.api import get_results, ensure_webhooks
 from srht.config import cfg, get_origin
 from srht.crypto import encrypt_request_authorization
 from srht.database import db
+from srht.deadline import http_timeout
 from srht.flask import DATE_FORMAT
 from srht.oauth import OAuthError, ExternalUserMixin, UserType, OAuthScope
+from srht.timing import timed, timed_function
 from urllib.parse import quote_plus
 from werkzeug.local import LocalProxy
 
@@ -84,12 +86,14 @@ class AbstractOAuthService(abc.ABC):
                 "writable": scope.writable,
             })
 
+    @timed_function("http")
     def _request(self, *args, **kwargs):
         headers = kwargs.pop("headers", dict())
         headers.update({
             "X-OAuth-ID": self.client_id,
             "X-OAuth-Secret": self.client_secret,
         })
+        kwargs["timeout"] = http_timeout(kwargs.get("timeout"))
         return requests.request(*args, headers=headers, **kwargs)
 
     def _preauthorized_warning(self):
@@ -136,11 +140,13 @@ If you are the admin of {metasrht}, run the following SQL to correct this:
         db.session.commit()
         return oauth_token
 
+    @timed_function("http")
     def fetch_unknown_user(self, username):
         """Fetch an unknown user profile with internal authorization"""
         r = requests.get(f"{metasrht}/api/user/profile",
                 headers=encrypt_request_authorization(user=
-                    type("User", tuple(), {"username": username})))
+                    type("User", tuple(), {"username": username})),
+                timeout=http_timeout())
         if r.status_code != 200:
             raise Exception(r.text)
         return r.json()
@@ -215,10 +221,12 @@ If you are the admin of {metasrht}, run the following SQL to correct this:
 
     def lookup_via_oauth(self, token, token_expires, scopes):
         User = self.User
+        timeout = http_timeout()
         try:
-            r = requests.get(f"{metasrht}/api/user/profile", headers={
-                "Authorization": f"token {token}",
-            })
+            with timed("http"):
+                r = requests.get(f"{metasrht}/api/user/profile", headers={
+                    "Authorization": f"token {token}",
+                }, timeout=timeout)
             profile = r.json()
         except Exception as ex:
             print(ex)
@@ -231,12 +239,14 @@ If you are the admin of {metasrht}, run the following SQL to correct this:
         user.oauth_token_scopes = scopes
         return user
 
+    @timed_function("http")
     def delegated_exchange(self, token, revocation_url):
         """
         Validates an OAuth token with meta.sr.ht and returns a tuple of
         meta.sr.ht's responses: token, profile. Raises an OAuthError if anything
         goes wrong.
         """
+        timeout = http_timeout()
         try:
             r = requests.post("{}/oauth/token/verify".format(metasrht),
                 json={
@@ -244,7 +254,7 @@ If you are the admin of {metasrht}, run the following SQL to correct this:
                     "client_secret": self.client_secret,
                     "revocation_url": revocation_url,
                     "oauth_token": token,
-                })
+                }, timeout=timeout)
             _token = r.json()
         except Exception as ex:
             print(ex)
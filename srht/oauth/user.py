@@ -71,3 +71,67 @@ class ExternalUserMixin(UserMixin):
     oauth_token_expires = sa.Column(sa.DateTime)
     oauth_token_scopes = sa.Column(sa.String)
     oauth_revocation_token = sa.Column(sa.String(256))
+
+class LazyUser:
+    """
+    Stands in for a user authenticated by the unified login cookie. Display
+    fields present in the cookie payload are served from it, and the user is
+    only loaded (via the given loader) when any other attribute is needed.
+    The account status (user_type, suspension_notice) is always loaded, as
+    the cookie may be outdated.
+    """
+    _cookie_fields = {"email", "url", "location", "bio"}
+
+    def __init__(self, info, loader):
+        self._info = info
+        self._loader = loader
+        self._user = None
+        self._loaded = False
+
+    def _get_current_object(self):
+        if not self._loaded:
+            self._user = self._loader(self._info["name"])
+            self._loaded = True
+        return self._user
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    @property
+    def username(self):
+        if self._user is not None:
+            return self._user.username
+        return self._info["name"]
+
+    @property
+    def canonical_name(self):
+        return "~" + self.username
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            return getattr(self._get_current_object(), name)
+        if self._user is None and name in self._cookie_fields \
+                and name in self._info:
+            return self._info[name]
+        return getattr(self._get_current_object(), name)
+
+    def __bool__(self):
+        # The user is unknown to us and meta.sr.ht could not provide it
+        return not self._loaded or self._user is not None
+
+    def __eq__(self, other):
+        if isinstance(other, LazyUser):
+            other = other._get_current_object()
+        return self._get_current_object() == other
+
+    def __hash__(self):
+        return hash(self._get_current_object())
+
+    def __repr__(self):
+        if self._user is not None:
+            return repr(self._user)
+        return '<LazyUser {}>'.format(self.username)
+
+    def __str__(self):
+        return self.canonical_name
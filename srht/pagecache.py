@@ -0,0 +1,185 @@
+"""
+srht.pagecache caches rendered pages and template fragments for anonymous
+users, i.e. visitors who are not logged in and have no session. Entries are
+stored in redis via srht.cache, with a small per-process LRU in front of it,
+and may be invalidated by tag with srht.cache.expunge_tag.
+
+Views opt in with the cached_response decorator:
+
+    @app.route("/~<owner>/<repo>")
+    @cached_response(ttl=300, tags=["repo:{owner}/{repo}"])
+    def summary(owner, repo): ...
+
+Templates opt in with the cache tag, whose arguments form the cache key:
+
+    {% cache "readme", repo.id, ttl=300, tags=["repo:" ~ repo.id] %}
+    ...
+    {% endcache %}
+"""
+from collections import OrderedDict
+from flask import current_app, request, Response, session as flask_session
+from functools import wraps
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+from srht import codec
+from srht.cache import get_cache, set_cache, get_tag_versions
+from srht.config import cfgi
+from threading import Lock
+from time import time
+import hashlib
+
+_local = OrderedDict()
+_local_lock = Lock()
+
+def _observe(kind, result):
+    metrics = getattr(current_app, "metrics", None)
+    if metrics and hasattr(metrics, "page_cache_requests"):
+        metrics.page_cache_requests.labels(kind=kind, result=result).inc()
+
+def _logged_in():
+    from srht.oauth import current_user
+    return bool(current_user) or "sr.ht.unified-login.v1" in request.cookies
+
+def _anonymous():
+    # Pages rendered for a visitor with a session may contain things such as
+    # their CSRF token, which must not be served to anyone else
+    cookie = current_app.config.get("SESSION_COOKIE_NAME", "session")
+    return not _logged_in() and cookie not in request.cookies \
+            and not _session_accessed()
+
+def _session_accessed():
+    return getattr(flask_session, "accessed", False)
+
+def _key(kind, parts):
+    digest = hashlib.sha256(codec.dumps(parts).encode()).hexdigest()
+    return f"srht.pagecache.{current_app.site}.{kind}.{digest}"
+
+def _get(kind, key):
+    now = time()
+    with _local_lock:
+        entry = _local.get(key)
+        if entry is not None:
+            _local.move_to_end(key)
+    layer = "local"
+    if entry is None or entry[0] < now:
+        layer = "redis"
+        entry = get_cache(key)
+        if entry is None:
+            _observe(kind, "miss")
+            return None
+        header, _, value = entry.partition(b"\n")
+        header = codec.loads(header)
+        entry = (header["expires"], header["tags"], header["versions"],
+                header["meta"], value)
+        _store_local(key, entry)
+    _, tags, versions, meta, value = entry
+    try:
+        if get_tag_versions(tags) != versions:
+            _observe(kind, "miss")
+            return None
+    except:
+        _observe(kind, "miss")
+        return None
+    _observe(kind, f"hit_{layer}")
+    return meta, value
+
+def _store_local(key, entry):
+    with _local_lock:
+        _local[key] = entry
+        _local.move_to_end(key)
+        while len(_local) > cfgi("sr.ht", "page-cache-size", default=256):
+            _local.popitem(last=False)
+
+def _set(key, ttl, tags, meta, value):
+    try:
+        versions = get_tag_versions(tags)
+    except:
+        return # Without tag versions, the entry could not be invalidated
+    expires = time() + ttl
+    header = codec.dumps({
+        "expires": expires, "tags": tags, "versions": versions, "meta": meta,
+    })
+    _store_local(key, (expires, tags, versions, meta, value))
+    set_cache(key, ttl, header.encode() + b"\n" + value)
+
+def cached_response(ttl=60, tags=[]):
+    """
+    Caches the response of a view for GET and HEAD requests by visitors who
+    are not logged in and have no session. The cache key varies by route,
+    view arguments and query string. Tags are format strings which are
+    formatted with the view arguments.
+    """
+    def wrap(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if request.method not in ("GET", "HEAD") or not _anonymous():
+                return f(*args, **kwargs)
+            key = _key("page", [
+                request.endpoint, request.view_args,
+                sorted(request.args.items(multi=True)),
+            ])
+            cached = _get("page", key)
+            if cached is not None:
+                meta, body = cached
+                resp = Response(body, status=meta["status"],
+                        mimetype=meta["mimetype"])
+                resp.vary.add("Cookie")
+                return resp
+            resp = current_app.make_response(f(*args, **kwargs))
+            resp.vary.add("Cookie")
+            if resp.status_code != 200 or resp.is_streamed \
+                    or "Set-Cookie" in resp.headers or _session_accessed():
+                return resp
+            _set(key, ttl, [t.format(**kwargs) for t in tags], {
+                "status": resp.status_code,
+                "mimetype": resp.mimetype,
+            }, resp.get_data())
+            return resp
+        return wrapper
+    return wrap
+
+class CacheExtension(Extension):
+    """
+    Adds the {% cache key... [, ttl=seconds] [, tags=[...]] %} tag, which
+    caches the rendered block for anonymous users.
+    """
+    tags = {"cache"}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key = []
+        options = {
+            "ttl": nodes.Const(60),
+            "tags": nodes.List([]),
+        }
+        first = True
+        while parser.stream.current.type != "block_end":
+            if not first:
+                parser.stream.expect("comma")
+            first = False
+            if parser.stream.current.type == "name" and \
+                    parser.stream.current.value in options and \
+                    parser.stream.look().type == "assign":
+                name = next(parser.stream).value
+                next(parser.stream)
+                options[name] = parser.parse_expression()
+            else:
+                key.append(parser.parse_expression())
+        body = parser.parse_statements(["name:endcache"], drop_needle=True)
+        return nodes.CallBlock(self.call_method("_cache", [
+            nodes.List(key), options["ttl"], options["tags"],
+        ]), [], [], body).set_lineno(lineno)
+
+    def _cache(self, key, ttl, tags, caller):
+        if not _anonymous():
+            return caller()
+        key = _key("fragment", [request.endpoint, key])
+        cached = _get("fragment", key)
+        if cached is not None:
+            return Markup(cached[1].decode())
+        value = caller()
+        if _session_accessed():
+            return value
+        _set(key, ttl, list(tags), {}, value.encode())
+        return value
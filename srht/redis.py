@@ -1,4 +1,28 @@
-from redis import from_url
+from redis import Redis
 from srht.config import cfg
+from srht.timing import timed
+from werkzeug.local import LocalProxy
 
-redis = from_url(cfg("sr.ht", "redis-host", "redis://localhost"))
+class TimedRedis(Redis):
+    def execute_command(self, *args, **options):
+        with timed("redis"):
+            return super().execute_command(*args, **options)
+
+_redis = None
+
+def _get_redis():
+    global _redis
+    if _redis is None:
+        _redis = TimedRedis.from_url(
+                cfg("sr.ht", "redis-host", "redis://localhost"))
+    return _redis
+
+redis = LocalProxy(_get_redis)
+
+def reset():
+    """
+    Drops the redis client, so that the next command opens new connections.
+    Call this in forked processes.
+    """
+    global _redis
+    _redis = None
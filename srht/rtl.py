@@ -0,0 +1,117 @@
+"""
+srht.rtl annotates HTML documents with dir="auto" on elements which contain
+right-to-left text, without building a full parse tree of the document.
+"""
+import re
+import unicodedata
+
+# Lead bytes of UTF-8 sequences which may encode a strong RTL character:
+# U+0580-U+08FF (Hebrew, Arabic, Syriac, Thaana, NKo, ...), U+FB00-U+FEFF
+# (presentation forms), U+10000-U+10FFF and U+1E000-U+1EFFF. This is a coarse
+# filter, matches are confirmed with unicodedata.
+_rtl_bytes = re.compile(
+        rb"[\xd6-\xdf]|\xe0[\xa0-\xa3]|\xef[\xac-\xbb]|\xf0[\x90\x9e]")
+
+_tag = re.compile(r"""
+    <!--.*?-->
+    | <(?P<close>/?)(?P<name>[A-Za-z][^\s/>]*)
+      (?P<attrs>(?:[^>"']|"[^"]*"|'[^']*')*)>
+""", re.DOTALL | re.VERBOSE)
+
+_dir_attr = re.compile(r"""\sdir\s*=""", re.IGNORECASE)
+
+_void_elements = {
+    "area", "base", "br", "col", "embed", "hr", "img", "input", "link",
+    "meta", "param", "source", "track", "wbr",
+}
+
+_raw_text_end = {
+    name: re.compile(f"</{name}", re.IGNORECASE)
+    for name in ["script", "style", "textarea"]
+}
+
+_input_elements = {"input", "textarea"}
+
+def _is_rtl(ch):
+    return unicodedata.bidirectional(ch) in ('R', 'AL')
+
+def _text_has_rtl(text):
+    return any(ord(ch) >= 0x580 and _is_rtl(ch) for ch in text)
+
+def has_rtl(data):
+    """
+    Returns True if the given UTF-8 encoded bytes contain any strong
+    right-to-left characters.
+    """
+    for match in _rtl_bytes.finditer(data):
+        start = match.start()
+        ch = data[start:start+4].decode("utf8", "ignore")
+        if ch and _is_rtl(ch[0]):
+            return True
+    return False
+
+def annotate_rtl(html, rtl=True):
+    """
+    Adds dir="auto" to every input and textarea within the document body and,
+    if rtl is true, to every element within the body whose text contains
+    strong right-to-left characters.
+
+    Returns the annotated document, or None if it has no body.
+    """
+    stack = []
+    marked = set()
+    in_body = saw_body = False
+    pos = 0
+    for match in _tag.finditer(html):
+        if match.start() < pos:
+            continue # Inside of a raw text element
+        name = match.group("name")
+        if rtl and stack and _text_has_rtl(html[pos:match.start()]):
+            marked.update(stack)
+        pos = match.end()
+        if name is None:
+            continue # Comment
+
+        name = name.lower()
+        if name == "body":
+            in_body = not match.group("close")
+            saw_body = True
+            stack.clear()
+            continue
+        if not in_body:
+            continue
+
+        if match.group("close"):
+            for i in range(len(stack) - 1, -1, -1):
+                if stack[i][1] == name:
+                    del stack[i:]
+                    break
+            continue
+
+        elem = (match.end("name"), name)
+        if name in _input_elements:
+            marked.add(elem)
+        if name in _void_elements:
+            continue
+        stack.append(elem)
+        if name in _raw_text_end:
+            end = _raw_text_end[name].search(html, pos)
+            end = end.start() if end else len(html)
+            if rtl and _text_has_rtl(html[pos:end]):
+                marked.update(stack)
+            pos = end
+
+    if not saw_body:
+        return None
+
+    out = []
+    last = 0
+    for offs, _ in sorted(marked):
+        tag_end = html.find(">", offs)
+        if _dir_attr.search(html[offs:tag_end]):
+            continue
+        out.append(html[last:offs])
+        out.append(' dir="auto"')
+        last = offs
+    out.append(html[last:])
+    return "".join(out)
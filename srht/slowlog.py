@@ -0,0 +1,98 @@
+"""
+srht.slowlog logs requests which take longer than [sr.ht]slow-request-threshold
+milliseconds, along with their timing breakdown and the normalized SQL
+statements they executed. Records are written as JSON lines to
+[sr.ht]slow-request-log (a file path), or to stderr if unset.
+"""
+from flask import g, has_app_context
+from srht import codec
+from srht.config import cfg, cfgi
+from srht.timing import timings
+import hashlib
+import logging
+import re
+import sys
+
+max_statements = 500
+
+_logger = None
+
+_whitespace = re.compile(r"\s+")
+_string = re.compile(r"'(?:[^']|'')*'")
+_number = re.compile(r"\b\d+(?:\.\d+)?\b")
+_param = re.compile(r"%\([^)]*\)s|%s|:\w+|\$\d+")
+_list = re.compile(r"\((?:\s*\?\s*,)+\s*\?\s*\)")
+
+def normalize_sql(statement):
+    """
+    Normalizes an SQL statement such that statements which only differ in
+    their parameters or literals are equal.
+    """
+    statement = _string.sub("?", statement)
+    statement = _param.sub("?", statement)
+    statement = _number.sub("?", statement)
+    statement = _whitespace.sub(" ", statement).strip()
+    return _list.sub("(...)", statement)
+
+def fingerprint(statement):
+    """Returns a short fingerprint of a normalized SQL statement."""
+    return hashlib.sha1(statement.encode()).hexdigest()[:16]
+
+def capture_statement(statement, duration):
+    """Records an SQL statement executed by the current request."""
+    if not has_app_context() or \
+            cfgi("sr.ht", "slow-request-threshold", default=None) is None:
+        return
+    statements = g.setdefault("_srht_statements", list())
+    if len(statements) < max_statements:
+        statements.append((statement, duration))
+
+def _get_logger():
+    global _logger
+    if _logger is None:
+        _logger = logging.getLogger("srht.slowlog")
+        _logger.propagate = False
+        _logger.setLevel(logging.INFO)
+        path = cfg("sr.ht", "slow-request-log", default=None)
+        if path:
+            handler = logging.FileHandler(path)
+        else:
+            handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        _logger.addHandler(handler)
+    return _logger
+
+def log_if_slow(site, method, route, path, status, duration):
+    """
+    Logs the current request if it took longer than the threshold. The
+    duration is in seconds.
+    """
+    threshold = cfgi("sr.ht", "slow-request-threshold", default=None)
+    if threshold is None or duration * 1000 < threshold:
+        return
+    statements = dict()
+    for statement, elapsed in g.get("_srht_statements", []):
+        normalized = normalize_sql(statement)
+        key = fingerprint(normalized)
+        entry = statements.setdefault(key, {
+            "fingerprint": key,
+            "statement": normalized,
+            "count": 0,
+            "duration_ms": 0,
+        })
+        entry["count"] += 1
+        entry["duration_ms"] += elapsed * 1000
+    _get_logger().info(codec.dumps({
+        "site": site,
+        "method": method,
+        "route": route,
+        "path": path,
+        "status": status,
+        "duration_ms": round(duration * 1000, 1),
+        "timings": {
+            category: {"count": count, "duration_ms": round(total * 1000, 1)}
+            for category, (count, total) in timings().items()
+        },
+        "statements": sorted(statements.values(),
+            key=lambda s: s["duration_ms"], reverse=True),
+    }))
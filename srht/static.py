@@ -0,0 +1,102 @@
+"""
+srht.static builds a manifest of content-hashed static assets, along with
+precompressed copies of each, so that they may be served with immutable
+caching. Run `python3 -m srht.static <static dir>` to build it.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MANIFEST = "manifest.json"
+
+_hashed = re.compile(r"\.[0-9a-f]{8}(\.[^.]+)?$")
+_compressible = {
+    ".css", ".js", ".svg", ".json", ".txt", ".html", ".map", ".xml", ".ttf",
+}
+
+def _walk(static_dir):
+    for root, dirs, files in os.walk(static_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if name == MANIFEST or name.endswith((".gz", ".br")):
+                continue
+            if _hashed.search(name):
+                continue # Already a hashed copy
+            yield os.path.relpath(os.path.join(root, name), static_dir)
+
+def hashed_name(path, data):
+    """Given static/example.ext, returns static/example.hash.ext"""
+    digest = hashlib.sha256(data).hexdigest()[:8]
+    path, ext = os.path.splitext(path)
+    return f"{path}.{digest}{ext}"
+
+def _compress(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    with gzip.open(path + ".gz", "wb", compresslevel=9) as f:
+        f.write(data)
+    if brotli:
+        with open(path + ".br", "wb") as f:
+            f.write(brotli.compress(data))
+
+def build_manifest(static_dir, prefix="static", write=True, compress=True):
+    """
+    Hashes every file in the static directory and returns a dict mapping each
+    path (e.g. static/main.min.css) to its hashed name (e.g.
+    static/main.min.0123abcd.css).
+
+    If write is true, hashed copies of each file and the manifest itself are
+    written to the static directory. If compress is also true, gzip (and
+    brotli, if available) compressed copies of text assets are written
+    alongside the hashed copies.
+    """
+    manifest = dict()
+    for path in _walk(static_dir):
+        full_path = os.path.join(static_dir, path)
+        with open(full_path, "rb") as f:
+            data = f.read()
+        hashed = hashed_name(path, data)
+        manifest[f"{prefix}/{path}"] = f"{prefix}/{hashed}"
+        if not write:
+            continue
+        hashed_path = os.path.join(static_dir, hashed)
+        if not os.path.exists(hashed_path):
+            shutil.copyfile(full_path, hashed_path)
+        if compress and os.path.splitext(path)[1] in _compressible:
+            _compress(hashed_path)
+    if write:
+        with open(os.path.join(static_dir, MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+def load_manifest(static_dir, prefix="static"):
+    """
+    Loads the manifest from the static directory, or hashes the static files
+    in memory if the manifest has not been built. Returns an empty manifest
+    if the static directory does not exist.
+    """
+    try:
+        with open(os.path.join(static_dir, MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+    if not os.path.isdir(static_dir):
+        return dict()
+    return build_manifest(static_dir, prefix=prefix, write=False)
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("Usage: python3 -m srht.static <static dir>")
+        sys.exit(1)
+    manifest = build_manifest(sys.argv[1])
+    print(f"Wrote {len(manifest)} entries to "
+            f"{os.path.join(sys.argv[1], MANIFEST)}")
@@ -0,0 +1,83 @@
+"""
+srht.timing accumulates the time spent on each kind of work (SQL, template
+rendering, markdown, redis, outbound HTTP) during a request, for the
+Server-Timing header and the request_component_time metric.
+"""
+from contextlib import contextmanager
+from flask import g, has_app_context
+from functools import wraps
+from jinja2 import Template
+from timeit import default_timer
+
+categories = {
+    "sql": "SQL queries",
+    "template": "Template rendering",
+    "markdown": "Markdown rendering",
+    "redis": "Redis commands",
+    "http": "Outbound HTTP requests",
+}
+
+def record(category, duration):
+    """Adds the duration of one operation to the current request's total."""
+    if not has_app_context():
+        return
+    timings = g.setdefault("_srht_timings", dict())
+    count, total = timings.get(category, (0, 0))
+    timings[category] = (count + 1, total + duration)
+
+@contextmanager
+def timed(category):
+    """
+    Times the enclosed block. Nested blocks of the same category are only
+    counted once, by the outermost block.
+    """
+    if not has_app_context():
+        yield
+        return
+    active = g.setdefault("_srht_timing_active", set())
+    if category in active:
+        yield
+        return
+    active.add(category)
+    start = default_timer()
+    try:
+        yield
+    finally:
+        active.discard(category)
+        record(category, max(default_timer() - start, 0))
+
+def timed_function(category):
+    """Decorator form of timed."""
+    def wrap(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with timed(category):
+                return f(*args, **kwargs)
+        return wrapper
+    return wrap
+
+def timings():
+    """
+    Returns a dict of category to (count, total seconds) for the current
+    request.
+    """
+    if not has_app_context():
+        return dict()
+    return g.get("_srht_timings", dict())
+
+def server_timing(total=None):
+    """Formats the current request's timings as a Server-Timing header."""
+    metrics = []
+    for category, (count, duration) in timings().items():
+        desc = categories.get(category, category)
+        metrics.append(f'{category};dur={duration * 1000:.1f};'
+            f'desc="{desc} ({count})"')
+    if total is not None:
+        metrics.append(f'total;dur={total * 1000:.1f}')
+    return ", ".join(metrics)
+
+class TimedTemplate(Template):
+    """A Jinja template which records its render time."""
+    def render(self, *args, **kwargs):
+        with timed("template"):
+            return super().render(*args, **kwargs)
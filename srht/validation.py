@@ -1,7 +1,7 @@
 from markupsafe import Markup
 from urllib import parse
 from enum import Enum, IntEnum
-import json
+from srht import codec
 
 class ValidationError:
     def __init__(self, field, message):
@@ -27,11 +27,11 @@ class Validation:
             contentType = request.headers.get("Content-Type")
             if contentType and contentType == "application/json":
                 try:
-                    self.source = json.loads(request.data.decode('utf-8'))
+                    self.source = codec.loads(request.data)
                     if not isinstance(self.source, dict):
                         self.error("Expected JSON dictionary")
                         self.source = {}
-                except json.JSONDecodeError:
+                except codec.JSONDecodeError:
                     self.error("Invalid JSON provided")
                     self.source = {}
             else:
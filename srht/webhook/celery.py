@@ -3,7 +3,7 @@ Import this module only after configuring your database.
 """
 
 from celery import Celery
-from srht.email import mail_exception
+from srht.email import report_exception
 from srht.database import db
 from srht.webhook import Webhook
 from werkzeug.local import LocalProxy
@@ -20,7 +20,7 @@ def make_worker(broker='redis://'):
             try:
                 return func(*args, **kwargs)
             except Exception as ex:
-                mail_exception(ex, context=f"webhook process")
+                report_exception(ex, context=f"webhook process")
                 try:
                     db.session.rollback()
                 except:
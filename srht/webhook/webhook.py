@@ -1,20 +1,21 @@
 import base64
 import binascii
-import json
 import os
 import requests
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from datetime import datetime
 from enum import Enum
 from flask import request, abort
 from srht.api import paginated_response
 from srht.crypto import sign_payload
+from srht.codec import dumps
 from srht.config import cfg
 from srht.database import db
-from srht.flask import date_handler
 from srht.oauth import oauth, current_token
 from srht.validation import Validation
 from srht.webhook.magic import WebhookMeta
+from sqlalchemy.orm import make_transient_to_detached
 from uuid import UUID
 
 class Webhook(metaclass=WebhookMeta):
@@ -53,9 +54,9 @@ class Webhook(metaclass=WebhookMeta):
         for f in filters:
             subs = subs.filter(f)
         responses = list()
-        for sub in subs.all():
-            if event in sub.events:
-                responses.append(cls.notify(sub, event, payload, **kwargs))
+        for chunk in db.stream_chunks(subs):
+            chunk = [sub for sub in chunk if event in sub.events]
+            responses.extend(cls.notify_many(chunk, event, payload, **kwargs))
         return responses
 
     def prepare_headers(cls, delivery):
@@ -69,7 +70,7 @@ class Webhook(metaclass=WebhookMeta):
 
     def notify(cls, sub, event, payload, **kwargs):
         """Notifies a single subscriber of a webhook event."""
-        payload = json.dumps(payload, default=date_handler)
+        payload = dumps(payload)
         delivery = cls.Delivery()
         delivery.event = event.value
         delivery.subscription_id = sub.id
@@ -83,6 +84,57 @@ class Webhook(metaclass=WebhookMeta):
         db.session.commit()
         return cls.process_delivery(delivery, headers, **kwargs)
 
+    def notify_many(cls, subs, event, payload, **kwargs):
+        """
+        Notifies many subscribers of a webhook event. The deliveries are
+        recorded with one INSERT and one commit, rather than one per
+        subscriber.
+        """
+        if not subs:
+            return []
+        payload = dumps(payload)
+        created = datetime.utcnow()
+        deliveries = list()
+        headers = dict()
+        for sub in subs:
+            delivery = cls.Delivery()
+            delivery.created = created
+            delivery.event = event.value
+            delivery.subscription_id = sub.id
+            delivery.url = sub.url
+            delivery.payload = payload[:65536]
+            h = headers[delivery.uuid] = cls.prepare_headers(delivery)
+            delivery.payload_headers = "\n".join(
+                    f"{key}: {value}" for key, value in h.items())
+            delivery.response_status = -2
+            deliveries.append(delivery)
+        columns = ["uuid", "created", "event", "subscription_id", "url",
+                "payload", "payload_headers", "response_status"]
+        rows = db.bulk_insert(cls.Delivery,
+                [{c: getattr(d, c) for c in columns} for d in deliveries],
+                returning=["id", "uuid"])
+        ids = {row.uuid: row.id for row in rows}
+        for delivery in deliveries:
+            # Attach the deliveries as the rows just inserted, so that the
+            # responses are recorded without loading them again
+            delivery.id = ids[delivery.uuid]
+            make_transient_to_detached(delivery)
+            db.session.add(delivery)
+        db.session.commit()
+
+        responses = list()
+        for delivery in deliveries:
+            try:
+                r = cls.process_delivery(delivery,
+                        headers[delivery.uuid], **kwargs)
+            except requests.exceptions.RequestException as ex:
+                delivery.response = str(ex)[:65536]
+                delivery.response_status = -1
+                db.session.commit()
+                r = None
+            responses.append(r)
+        return responses
+
     def process_delivery(cls, delivery, headers):
         try:
             r = requests.post(delivery.url, data=delivery.payload,